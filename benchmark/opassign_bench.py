@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+"""Throughput benchmark for opassign.py and opassign2.py on synthetic operon reads.
+
+Generates a reproducible read set (and a toy reference for -e nb), runs every
+combination of strategy, thread count and chunk size, and appends one JSON line
+per run with reads/s, bases/s, peak RSS of the whole process tree and the time
+spent in each stage. Runs using RDP Classifier go through benchmark/stub/java
+unless --java is given, so no Java or trained model is needed. --java only
+applies to opassign2.py, since opassign.py always classifies with its built-in
+PATH_RDPCLASSIFIER_DB.
+
+    opassign_bench.py -o results.jsonl --reads 20000 -s opassign2,opassign2-persistent -t 1,4 -c 500,2000
+    opassign_bench.py --compare before.jsonl after.jsonl
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import psutil
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+STUB_DIR = os.path.join(BENCH_DIR, "stub")
+
+# Approximate lengths of the parts of a bacterial rrn operon
+OPERON_PARTS = [1550, 450, 2900]
+
+# Strategy -> script and extra options; {chunk_bases} is -c times the mean read length
+STRATEGIES = {
+    "opassign": ["opassign.py"],
+    "opassign-persistent": ["opassign.py", "--persistent"],
+    "opassign2": ["opassign2.py"],
+    "opassign2-persistent": ["opassign2.py", "--persistent"],
+    "opassign2-derep": ["opassign2.py", "--derep"],
+    "opassign2-bases": ["opassign2.py", "-b", "{chunk_bases}"],
+    "opassign2-pipe": ["opassign2.py", "--pipe"],
+    "opassign2-nb": ["opassign2.py", "-e", "nb"],
+}
+
+# Lines the scripts print as they move from one stage to the next
+STAGE_MARKERS = [
+    ("Loading the naive Bayesian classifier", "load_model"),
+    ("Counting the total number of sequences", "count"),
+    ("Total number of sequences", "classify"),
+    ("All done.", None),
+]
+
+# Interval between samples of the process tree's memory
+RSS_INTERVAL = 0.05
+
+def mutate(rng, seq, rate):
+    """Applies substitutions, insertions and deletions at the given total rate."""
+    bases = []
+    for base in seq:
+        r = rng.random()
+        if r >= rate:
+            bases.append(base)
+        elif r < rate / 2:
+            bases.append(rng.choice("ACGT"))
+        elif r < rate * 3 / 4:
+            bases.append(base + rng.choice("ACGT"))
+    return "".join(bases)
+
+def make_dataset(directory, args):
+    """Writes reads.fasta.gz and reference.fasta for the dataset options, unless already there."""
+    reads_file = os.path.join(directory, "reads.fasta.gz")
+    if os.path.exists(reads_file):
+        return
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(args.seed)
+
+    # Taxa with a full 7-rank lineage and an operon of varying length
+    taxa = []
+    for t in range(args.taxa):
+        names = ["Bacteria", f"Phylum{t % 3}", f"Class{t % 5}", f"Order{t % 8}", f"Family{t % 13}", f"Genus{t % 21}", f"Species{t}"]
+        lineage = ["Root"] + ["|".join(names[:i + 1]) for i in range(7)]
+        length = max(200, int(rng.gauss(args.length_mean, args.length_sd)))
+        operon = "".join("".join(rng.choice("ACGT") for _ in range(part * length // sum(OPERON_PARTS))) for part in OPERON_PARTS)
+        taxa.append((lineage, operon))
+
+    # Training set in the layout grond2refdb.py writes, a few variants per taxon
+    with open(os.path.join(directory, "reference.fasta"), "w") as f:
+        n = 0
+        for lineage, operon in taxa:
+            for _ in range(3):
+                n += 1
+                f.write(f">{n}\t{';'.join(lineage)}\n{mutate(rng, operon, 0.01)}\n")
+
+    reads = []
+    with gzip.GzipFile(reads_file, "wb", mtime=0) as raw:
+        for i in range(args.reads):
+            if reads and rng.random() < args.duplicates:
+                seq = rng.choice(reads)
+            else:
+                lineage, operon = rng.choice(taxa)
+                seq = mutate(rng, operon, args.error_rate)
+                if rng.random() < args.partial:
+                    length = rng.randint(min(500, len(seq)), len(seq))
+                    start = rng.randint(0, len(seq) - length)
+                    seq = seq[start:start + length]
+                reads.append(seq)
+            raw.write(f">read{i}\n{seq}\n".encode())
+
+def dataset_stats(directory):
+    num_reads = num_bases = 0
+    with gzip.open(os.path.join(directory, "reads.fasta.gz"), "rt") as f:
+        for line in f:
+            if line.startswith(">"):
+                num_reads += 1
+            else:
+                num_bases += len(line) - 1
+    return num_reads, num_bases
+
+def train_model(directory):
+    """Compiles the toy reference for -e nb; returns the seconds it took, 0 if already compiled."""
+    model = os.path.join(directory, "reference.rdpnb")
+    if os.path.exists(model):
+        return 0.0
+    start = time.perf_counter()
+    subprocess.run([sys.executable, os.path.join(REPO_DIR, "rdpnb.py"), "-r", os.path.join(directory, "reference.fasta"), "-m", model],
+                   check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+def watch_rss(process, peak, done):
+    """Samples the summed RSS of a process and its descendants until done is set."""
+    root = psutil.Process(process.pid)
+    while not done.is_set():
+        try:
+            rss = sum(p.memory_info().rss for p in [root] + root.children(recursive=True))
+        except psutil.Error:
+            rss = 0
+        peak[0] = max(peak[0], rss)
+        done.wait(RSS_INTERVAL)
+
+def run_once(command, env, log_file):
+    """Runs a command, returning its exit code, wall time, peak RSS and stage times from its output."""
+    stages = {}
+    stage, stage_start = "startup", time.perf_counter()
+    start = stage_start
+    peak, done = [0], threading.Event()
+    with open(log_file, "w") as log:
+        process = subprocess.Popen(command, env=env, stdout=subprocess.PIPE, stderr=log, text=True)
+        watcher = threading.Thread(target=watch_rss, args=(process, peak, done), daemon=True)
+        watcher.start()
+        for line in process.stdout:
+            log.write(line)
+            for marker, next_stage in STAGE_MARKERS:
+                if line.startswith(marker):
+                    now = time.perf_counter()
+                    stages[stage] = stages.get(stage, 0.0) + now - stage_start
+                    stage, stage_start = next_stage, now
+        returncode = process.wait()
+    wall = time.perf_counter() - start
+    if stage:
+        stages[stage] = stages.get(stage, 0.0) + time.perf_counter() - stage_start
+    done.set()
+    watcher.join()
+    return returncode, wall, peak[0], stages
+
+def git_version():
+    try:
+        commit = subprocess.run(["git", "-C", REPO_DIR, "describe", "--always", "--dirty"], capture_output=True, text=True, check=True)
+        return commit.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def compare(before_file, after_file):
+    """Prints the reads/s of matching runs in two result files and their ratio."""
+    def load(path):
+        runs = {}
+        with open(path) as f:
+            for line in f:
+                run = json.loads(line)
+                if run["returncode"] == 0:
+                    key = (run["dataset"], run["strategy"], run["threads"], run["chunksize"])
+                    runs.setdefault(key, []).append(run["reads_per_s"])
+        return {key: max(values) for key, values in runs.items()}
+    before, after = load(before_file), load(after_file)
+    print("strategy\tthreads\tchunksize\tbefore_reads_per_s\tafter_reads_per_s\tratio")
+    for key in sorted(before.keys() & after.keys()):
+        print(f"{key[1]}\t{key[2]}\t{key[3]}\t{before[key]:.1f}\t{after[key]:.1f}\t{after[key] / before[key]:.2f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Throughput benchmark for opassign on synthetic operon reads")
+    parser.add_argument("-o", dest="outfile", metavar="outfile", help="[REQUIRED] JSON lines file the results are appended to")
+    parser.add_argument("-w", dest="workdir", metavar="workdir", help="[OPTIONAL] Directory for datasets and run outputs", default="bench_work")
+    parser.add_argument("-s", dest="strategies", metavar="strategies", help=f"[OPTIONAL] Comma-separated strategies: {','.join(STRATEGIES)}", default="opassign,opassign2,opassign2-persistent")
+    parser.add_argument("-t", dest="threads", metavar="threads", help="[OPTIONAL] Comma-separated thread counts", default="1,2,4")
+    parser.add_argument("-c", dest="chunksizes", metavar="chunksizes", help="[OPTIONAL] Comma-separated chunk sizes (reads)", default="200,1000")
+    parser.add_argument("-r", dest="repeats", metavar="repeats", help="[OPTIONAL] Runs per combination", default="1")
+    parser.add_argument("--reads", dest="reads", metavar="reads", type=int, help="[OPTIONAL] Reads in the dataset", default=5000)
+    parser.add_argument("--length-mean", dest="length_mean", metavar="length_mean", type=int, help="[OPTIONAL] Mean operon length", default=4900)
+    parser.add_argument("--length-sd", dest="length_sd", metavar="length_sd", type=int, help="[OPTIONAL] Standard deviation of the operon length", default=300)
+    parser.add_argument("--partial", dest="partial", metavar="partial", type=float, help="[OPTIONAL] Fraction of partial reads", default=0.2)
+    parser.add_argument("--duplicates", dest="duplicates", metavar="duplicates", type=float, help="[OPTIONAL] Fraction of reads repeating an earlier read exactly", default=0.3)
+    parser.add_argument("--error-rate", dest="error_rate", metavar="error_rate", type=float, help="[OPTIONAL] Per-base error rate of the reads", default=0.05)
+    parser.add_argument("--taxa", dest="taxa", metavar="taxa", type=int, help="[OPTIONAL] Taxa in the toy reference", default=40)
+    parser.add_argument("--seed", dest="seed", metavar="seed", type=int, help="[OPTIONAL] Random seed of the dataset", default=1)
+    parser.add_argument("--java", dest="java", metavar="rdp_db", help="[OPTIONAL] Use the real java with this rRNAClassifier.properties instead of the stub (opassign2 strategies only)")
+    parser.add_argument("--stub-startup-ms", dest="stub_startup_ms", metavar="ms", help="[OPTIONAL] Simulated JVM start and model load of the stub", default="500")
+    parser.add_argument("--stub-ns-per-base", dest="stub_ns_per_base", metavar="ns", help="[OPTIONAL] Simulated classification time per base of the stub", default="100")
+    parser.add_argument("--compare", nargs=2, dest="compare", metavar=("before", "after"), help="[OPTIONAL] Compare two result files instead of running")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        sys.exit(0)
+    if not args.outfile:
+        parser.error("-o is required unless --compare is given")
+    strategies = args.strategies.split(",")
+    for strategy in strategies:
+        if strategy not in STRATEGIES:
+            parser.error(f"unknown strategy {strategy}")
+        # opassign.py has no -d, so it would be benchmarked on another model
+        if args.java and STRATEGIES[strategy][0] == "opassign.py":
+            parser.error(f"--java does not apply to {strategy}: opassign.py always uses its built-in PATH_RDPCLASSIFIER_DB")
+
+    dataset_options = {name: getattr(args, name) for name in ("reads", "length_mean", "length_sd", "partial", "duplicates", "error_rate", "taxa", "seed")}
+    dataset = hashlib.sha256(json.dumps(dataset_options, sort_keys=True).encode()).hexdigest()[:12]
+    directory = os.path.join(args.workdir, dataset)
+
+    # Time spent preparing the dataset, 0 when it was already there
+    dataset_stages = {}
+    start = time.perf_counter()
+    make_dataset(directory, args)
+    dataset_stages["generate"] = time.perf_counter() - start
+    if any(strategy.endswith("-nb") for strategy in strategies):
+        dataset_stages["train"] = train_model(directory)
+    num_reads, num_bases = dataset_stats(directory)
+    print(f"Dataset {dataset}: {num_reads} reads, {num_bases} bases", file=sys.stderr)
+
+    # Unbuffered, so stage markers arrive when they are printed
+    env = dict(os.environ, PYTHONUNBUFFERED="1", STUB_STARTUP_MS=args.stub_startup_ms, STUB_NS_PER_BASE=args.stub_ns_per_base)
+    if not args.java:
+        env["PATH"] = STUB_DIR + os.pathsep + env["PATH"]
+    rdp_db = os.path.abspath(args.java) if args.java else os.path.join(STUB_DIR, "rRNAClassifier.properties")
+    version = git_version()
+
+    with open(args.outfile, "a") as results:
+        for strategy in strategies:
+            for threads in args.threads.split(","):
+                for chunksize in args.chunksizes.split(","):
+                    for repeat in range(int(args.repeats)):
+                        run_dir = os.path.join(directory, "runs", f"{strategy}_t{threads}_c{chunksize}_{repeat}")
+                        os.makedirs(run_dir, exist_ok=True)
+                        script, *extra = STRATEGIES[strategy]
+                        extra = [option.format(chunk_bases=int(chunksize) * (num_bases // num_reads)) for option in extra]
+                        command = [sys.executable, os.path.join(REPO_DIR, script), "-i", os.path.join(directory, "reads.fasta.gz"),
+                                   "-o", os.path.join(run_dir, "assigned.txt"), "-t", threads, "-c", chunksize] + extra
+                        if script == "opassign2.py":
+                            command += ["-d", os.path.join(directory, "reference.rdpnb") if "nb" in extra else rdp_db]
+                        returncode, wall, peak_rss, run_stages = run_once(command, env, os.path.join(run_dir, "log.txt"))
+                        run = {
+                            "version": version, "dataset": dataset, **dataset_options,
+                            "strategy": strategy, "threads": int(threads), "chunksize": int(chunksize), "repeat": repeat,
+                            "returncode": returncode, "wall_s": round(wall, 3),
+                            "reads_per_s": round(num_reads / wall, 1), "bases_per_s": round(num_bases / wall, 1),
+                            "peak_rss_mb": round(peak_rss / 2**20, 1),
+                            "stages_s": {name: round(seconds, 3) for name, seconds in run_stages.items()},
+                            "dataset_s": {name: round(seconds, 3) for name, seconds in dataset_stages.items()},
+                            "cpus": os.cpu_count(), "python": sys.version.split()[0], "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                        }
+                        results.write(json.dumps(run) + "\n")
+                        results.flush()
+                        print(f"{strategy} -t {threads} -c {chunksize}: {run['reads_per_s']} reads/s, {run['peak_rss_mb']} MB"
+                              + ("" if returncode == 0 else f" (exit code {returncode}, see {run_dir}/log.txt)"), file=sys.stderr)
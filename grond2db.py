@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+############################################################
+# Builds every reference file of a GROND release in one pass
+# over the taxonomy and the FASTA:
+#
+#   <prefix>.refseq.fasta, <prefix>.reftax.txt   as grond2refdb.py -r/-t
+#   <prefix>.rdp.tax, <prefix>.utax.tax,
+#   <prefix>.gi_tax.map, <prefix>.rdp.fa,
+#   <prefix>.utax.fa                             as tax2rdp_utax.pl on those
+#   <prefix>.sintax.fasta                        as grond2vsintax.py -o
+#
+# Example:
+# ./grond2db.py --fas GROND.fasta --tax GROND.tsv -o grond -t 8
+############################################################
+
+import argparse
+parser = argparse.ArgumentParser("Builds the RDP, UTAX and SINTAX reference files of a GROND release.")
+parser.add_argument("--fas",
+                    action = "store",
+                    dest = "fas",
+                    metavar = "fas",
+                    help = "[REQUIRED] FASTA input",
+                    required = True)
+parser.add_argument("--tax",
+                    action = "store",
+                    dest = "tax",
+                    metavar = "tax",
+                    help = "[REQUIRED] TAXA input",
+                    required = True)
+parser.add_argument("-o",
+                    action = "store",
+                    dest = "prefix",
+                    metavar = "prefix",
+                    help = "[REQUIRED] Prefix of the output files",
+                    required = True)
+parser.add_argument("-t",
+                    action = "store",
+                    dest = "threads",
+                    metavar = "threads",
+                    help = "[OPTIONAL] Number of processes parsing the FASTA",
+                    default = "1")
+options = parser.parse_args()
+
+############################################################
+
+import multiprocessing
+import sys
+from functools import partial
+
+# Characters of FASTA read at a time; each block goes to a worker as whole records
+BLOCK_SIZE = 4 * 1024 * 1024
+
+RANKS = ["rootrank", "kingdom", "phylum", "class", "order", "family", "genus", "species", "sub1", "sub2", "sub3", "sub4"]
+
+class TaxonTrie:
+    """Interned lineages: every taxon is a node under its parent, starting from Root (node 0)."""
+
+    def __init__(self):
+        self.children = {}  # (parent node, name) -> node
+        self.parent = [-1]
+        self.name = ["Root"]
+        self.depth = [0]
+        self.rdp_id = [-1]  # Taxon ID in the RDP/UTAX files, numbered in order of first use
+
+    def intern(self, names):
+        node = 0
+        for name in names:
+            child = self.children.get((node, name))
+            if child is None:
+                child = self.children[(node, name)] = len(self.parent)
+                self.parent.append(node)
+                self.name.append(name)
+                self.depth.append(self.depth[node] + 1)
+                self.rdp_id.append(-1)
+            node = child
+        return node
+
+    def path(self, node):
+        nodes = []
+        while node > 0:
+            nodes.append(node)
+            node = self.parent[node]
+        return nodes[::-1]
+
+    def number(self, node, taxa):
+        """Numbers the taxa from Root down to node that have no RDP ID yet, appending them to taxa."""
+        for taxon in [0] + self.path(node):
+            if self.rdp_id[taxon] < 0:
+                self.rdp_id[taxon] = len(taxa)
+                taxa.append(taxon)
+        return self.rdp_id[node]
+
+    def rdp_name(self, node):
+        # Root, then the lineage down to the taxon joined by '|'
+        return "|".join(self.name[taxon] for taxon in self.path(node)) if node else "Root"
+
+def read_tax():
+    """Reads the 7-rank lineages as {ID: leaf node}, with each leaf's RDP and SINTAX lineage strings."""
+    trie = TaxonTrie()
+    tax = {}
+    lineages = {}
+    with open(options.tax) as in_tax:
+        for line in in_tax:
+
+            # C_00000001      d__Bacteria|p__Proteobacteria|c__Gammaproteobacteria|o__Enterobacterales|f__Enterobacteriaceae|g__Enterobacter|s__Enterobacter asburiae_B
+            fields = line.rstrip().split("\t")
+            full_lineage = fields[1].split("|")
+            if len(full_lineage) != 7:
+                continue
+            names = [level.replace(" ", "_").split("__")[1] for level in full_lineage]
+
+            node = trie.intern(names)
+            tax[fields[0]] = node
+            if node not in lineages:
+                rdp = "Root;" + ";".join("|".join(names[:i + 1]) for i in range(7))
+                sintax = "tax=" + ",".join(rank + ":" + name for rank, name in zip("kpcofgs", names))
+                lineages[node] = (rdp, sintax)
+    return trie, tax, lineages
+
+def read_blocks():
+    """Streams the FASTA as blocks of whole records."""
+    rest = ""
+    with open(options.fas) as in_fas:
+        for block in iter(partial(in_fas.read, BLOCK_SIZE), ""):
+            block = rest + block
+            end = block.rfind("\n>")
+            if end < 0:
+                rest = block
+                continue
+            yield block[:end + 1]
+            rest = block[end + 1:]
+    if rest:
+        yield rest
+
+def format_block(block):
+    """Parses a block of FASTA records into (leaf node or None, sequence ID, sequence, SINTAX record)."""
+    entries = block.split("\n>")
+    if entries[0].startswith(">"):
+        entries[0] = entries[0][1:]
+    else:
+        entries = entries[1:]  # Anything before the first record
+    records = []
+    for entry in entries:
+        header, _, sequence = entry.partition("\n")
+        seqID = header.rstrip()
+        node = tax.get(seqID)
+        if node is None:
+            records.append((None, seqID, None, None))
+            continue
+        # As Bio.SeqIO reads FASTA sequences
+        sequence = "".join(line.rstrip() for line in sequence.split("\n")).replace(" ", "").replace("\r", "")
+        records.append((node, seqID, sequence, ">" + seqID + ";" + lineages[node][1] + "\n" + sequence + "\n"))
+    return records
+
+if __name__ == '__main__':
+
+    trie, tax, lineages = read_tax()
+
+    threads = int(options.threads)
+    pool = multiprocessing.Pool(threads) if threads > 1 else None
+    blocks = pool.imap(format_block, read_blocks()) if pool else map(format_block, read_blocks())
+
+    out_refseq = open(options.prefix + ".refseq.fasta", "w")
+    out_reftax = open(options.prefix + ".reftax.txt", "w")
+    out_map = open(options.prefix + ".gi_tax.map", "w")
+    out_rdp_fa = open(options.prefix + ".rdp.fa", "w")
+    out_utax_fa = open(options.prefix + ".utax.fa", "w")
+    out_sintax = open(options.prefix + ".sintax.fasta", "w")
+
+    # Sequences are numbered, and their taxa given RDP IDs, in FASTA order
+    taxa = []
+    counter = 1
+    skipped = 0
+    for records in blocks:
+        for node, seqID, sequence, sintax in records:
+            if node is None:
+                skipped += 1
+                continue
+            rdp = lineages[node][0]
+            taxID = trie.number(node, taxa)
+
+            out_refseq.write(">" + str(counter) + "\t" + rdp + "\n" + sequence + "\n")
+            out_reftax.write(str(counter) + "\t" + rdp + "\n")
+            out_map.write(str(counter) + "\t" + str(taxID) + "\n")
+            out_rdp_fa.write(">" + str(counter) + " " + rdp + "\n" + sequence + "\n")
+            out_utax_fa.write(">" + str(counter) + ";tax=" + str(taxID) + "; " + rdp + "\n" + sequence + "\n")
+            out_sintax.write(sintax)
+
+            counter += 1
+
+    if pool:
+        pool.close()
+        pool.join()
+    for f in (out_refseq, out_reftax, out_map, out_rdp_fa, out_utax_fa, out_sintax):
+        f.close()
+
+    # taxid*taxon_name*parent_taxid*depth*rank, and taxid <TAB> parent_taxid <TAB> taxon_name <TAB> rank
+    with open(options.prefix + ".rdp.tax", "w") as out_rdp, open(options.prefix + ".utax.tax", "w") as out_utax:
+        for taxon in taxa:
+            rdp_id = trie.rdp_id[taxon]
+            parent_id = trie.rdp_id[trie.parent[taxon]] if taxon else -1
+            name = trie.rdp_name(taxon)
+            rank = RANKS[trie.depth[taxon]]
+            out_rdp.write(f"{rdp_id}*{name}*{parent_id}*{trie.depth[taxon]}*{rank}\n")
+            out_utax.write(f"{rdp_id}\t{parent_id}\t{name}\t{rank}\n")
+
+    print(f"Sequences written: {counter - 1}; without a 7-rank lineage in --tax: {skipped}", file = sys.stderr)
@@ -1,22 +1,54 @@
 #!/usr/bin/env python
 
 import argparse
+import asyncio
 import gzip
-import multiprocessing
+import io
 import os
+import resource
 import shutil
 import subprocess
+import time
 from Bio import SeqIO
-from multiprocessing import Manager, cpu_count
 import progressbar
+import psutil
+from seqindex import RecordRange, SeqIndex, file_format
 
 parser = argparse.ArgumentParser("seqdemu: A No-Nonsense Nanopore Demultiplexer.")
 parser.add_argument("-i", action="store", dest="infile", metavar="infile", help="[REQUIRED]", required=True)
 parser.add_argument("-o", action="store", dest="outfile", metavar="outfile", help="[REQUIRED]", required=True)
 parser.add_argument("-c", action = "store", dest = "chunksize", metavar = "chunksize", help = "[OPTIONAL] Chunk size", default = "1000")
 parser.add_argument("-t", action="store", dest="threads", metavar="threads", help="[REQUIRED]", required=True)
+parser.add_argument("--persistent", action="store_true", dest="persistent", help="[OPTIONAL] Keep one RDP Classifier JVM per worker and load the model only once")
+parser.add_argument("--temp-dir", action="store", dest="temp_dir", metavar="temp_dir", help="[OPTIONAL] Directory for chunk files and the run manifest (default: <outfile>.tmp)")
+parser.add_argument("--resume", action="store_true", dest="resume", help="[OPTIONAL] Reuse the chunks a previous run of the same command finished")
+parser.add_argument("--mem-budget", action="store", dest="mem_budget", metavar="mem_budget", help="[OPTIONAL] Memory for all classifiers together, e.g. 200g: sizes each JVM heap and runs fewer than -t chunks at once if they would not fit")
+parser.add_argument("--no-count", action="store_true", dest="no_count", help="[OPTIONAL] Skip counting sequences and show progress by input bytes read")
 options = parser.parse_args()
 
+# Read size used when counting record starts in the input
+COUNT_BLOCK_SIZE = 16 * 1024 * 1024
+
+# Chunks read ahead per classifier: one being classified, one waiting
+QUEUE_DEPTH = 2
+
+# With --mem-budget, a classifier reserves the largest peak RSS measured so far times
+# MEMORY_HEADROOM, and the JVM heap is capped at the first such reservation
+MEMORY_HEADROOM = 1.25
+MIN_HEAP_MB = 512
+# The host counts as swapping above this many bytes swapped in per second,
+# checked at most every SWAP_CHECK_INTERVAL seconds
+SWAP_IN_RATE = 1024 * 1024
+SWAP_CHECK_INTERVAL = 1.0
+
+MAX_RAM = "1000g"
+PATH_CLASSIFIER = "/home/xc917132/applications/rdp_classifier_2.14/dist/classifier.jar"
+PATH_RDPCLASSIFIER_DB = "/home/xc917132/applications/rdp_db/GROND_trained_207/GROND_retrained/rRNAClassifier.properties"
+PATH_RDPWORKER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rdpworker")
+
+# Byte-offset index of a plain input; its chunks are read as byte ranges instead of parsed
+seq_index = None
+
 def is_gzipped(filename):
     """Check if a file is gzipped."""
     try:
@@ -32,76 +64,393 @@ def open_file(filename, mode='rt'):
     else:
         return open(filename, mode)
 
-def process_chunk(chunk_data, progress_counter, lock, chunk_size, temp_dir):
-    """Process a chunk of data."""
-    temp_file = os.path.join(temp_dir, f"temp_chunk_{progress_counter.value}.fasta")
-    with open_file(temp_file, 'wt') as f:
-        SeqIO.write(chunk_data, f, "fasta")
+def open_input(filename):
+    """Open the input for streaming; also returns the raw file to report bytes consumed."""
+    raw = open(filename, "rb")
+    return (gzip.open(raw, "rt") if is_gzipped(filename) else io.TextIOWrapper(raw)), raw
 
-    output_file = os.path.join(temp_dir, f"{progress_counter.value}_assigned_taxonomy_rdp_raw.txt")
-    
-    MAX_RAM = "1000g"
-    PATH_CLASSIFIER = "/home/xc917132/applications/rdp_classifier_2.14/dist/classifier.jar"
-    PATH_RDPCLASSIFIER_DB = "/home/xc917132/applications/rdp_db/GROND_trained_207/GROND_retrained/rRNAClassifier.properties"
+def input_format(filename):
+    """fasta or fastq, from the first byte of a plain or gzipped file."""
+    with open_file(filename, "rb") as f:
+        return file_format(f.read(1))
+
+def parse_size(text):
+    """Bytes in a size such as 500m or 64g."""
+    units = {"k": 2**10, "m": 2**20, "g": 2**30, "t": 2**40}
+    text = text.strip().lower().rstrip("b")
+    if text[-1:] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+class MemoryBudget:
+    """Limits the classifiers run at once so their measured memory fits in a budget (--mem-budget).
+
+    The first chunk runs alone with the whole budget as its heap. The largest peak RSS of
+    the classifiers that have exited so far then sets each one's reservation, and the
+    first measurement its JVM heap. Fewer are started while the host swaps."""
+
+    def __init__(self, budget, num_workers):
+        self.budget = budget
+        self.num_workers = num_workers
+        self.reserve = None  # Bytes per running classifier; None until the first one is measured
+        self.heap_mb = None
+        self.running = 0
+        self.cap = num_workers  # Lowered while the host swaps
+        self.condition = asyncio.Condition()
+        self.last_check = time.time()
+        self.swapped_in = psutil.swap_memory().sin
+
+    def limit(self):
+        if self.reserve is None:
+            return 1
+        return max(1, min(self.num_workers, int(self.budget // self.reserve), self.cap))
+
+    def heap(self):
+        """JVM -Xmx for the next chunk: the whole budget for the first one, then the reservation."""
+        return f"{self.heap_mb or max(MIN_HEAP_MB, self.budget // 2**20)}m"
+
+    def check_swap(self):
+        now = time.time()
+        if now - self.last_check < SWAP_CHECK_INTERVAL:
+            return
+        swapped_in = psutil.swap_memory().sin
+        if (swapped_in - self.swapped_in) / (now - self.last_check) > SWAP_IN_RATE:
+            self.cap = max(1, min(self.cap, self.running) - 1)
+        elif self.cap < self.num_workers:
+            self.cap += 1
+        self.last_check, self.swapped_in = now, swapped_in
+
+    async def acquire(self):
+        """Waits until one more classifier fits."""
+        async with self.condition:
+            self.check_swap()
+            while self.running >= self.limit():
+                try:
+                    await asyncio.wait_for(self.condition.wait(), SWAP_CHECK_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                self.check_swap()
+            self.running += 1
+
+    async def release(self):
+        async with self.condition:
+            # Peak RSS of the largest classifier reaped so far
+            peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+            if peak:
+                if self.reserve is None:
+                    self.heap_mb = max(MIN_HEAP_MB, int(peak * MEMORY_HEADROOM // 2**20))
+                    if peak * MEMORY_HEADROOM > self.budget:
+                        print(f"A classifier needs {peak * MEMORY_HEADROOM / 2**30:.1f} GB, over --mem-budget; running one at a time.")
+                # The heap stays fixed, so later, larger classifiers only raise the reservation
+                self.reserve = max(self.reserve or 0, peak * MEMORY_HEADROOM)
+            self.running -= 1
+            self.condition.notify_all()
+
+def java_heap(heap):
+    """-Xms and -Xmx options for a JVM with at most heap."""
+    return [f"-Xms{min(MIN_HEAP_MB, parse_size(heap) // 2**20)}M", f"-Xmx{heap}"]
+
+async def start_classifier(heap=MAX_RAM):
+    """Start a long-lived RDP Classifier (--persistent)."""
+    return await asyncio.create_subprocess_exec(
+        "java", "-XX:ActiveProcessorCount=1", *java_heap(heap),
+        "-cp", f"{PATH_CLASSIFIER}{os.pathsep}{PATH_RDPWORKER}", "RDPWorker", PATH_RDPCLASSIFIER_DB,
+        stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE)
+
+async def classify_persistent(classifier, fasta, output_file):
+    """Send a batch of sequences to a long-lived classifier and write its results."""
+    classifier.stdin.write(fasta + b"//\n")
+    await classifier.stdin.drain()
+    with open(output_file, "wb") as f:
+        while True:
+            line = await classifier.stdout.readline()
+            if not line:
+                raise RuntimeError(f"RDP Classifier worker exited with code {await classifier.wait()}")
+            if line == b"//\n":
+                return
+            f.write(line)
+
+async def classify(fasta, output_file, heap=MAX_RAM):
+    """Run one RDP Classifier on a chunk fed through its stdin."""
+    command = ["java", "-XX:ActiveProcessorCount=1", *java_heap(heap), "-jar", PATH_CLASSIFIER,
+               "classify", "-t", PATH_RDPCLASSIFIER_DB, "-o", output_file, "/dev/stdin"]
+    process = await asyncio.create_subprocess_exec(*command, stdin=asyncio.subprocess.PIPE)
+    try:
+        try:
+            process.stdin.write(fasta)
+            await process.stdin.drain()
+            process.stdin.close()
+        except (BrokenPipeError, ConnectionResetError):  # The JVM failed; its exit code says why
+            pass
+        if await process.wait():
+            raise subprocess.CalledProcessError(process.returncode, " ".join(command))
+    finally:
+        if process.returncode is None:  # The run is stopping on another chunk's error
+            process.kill()
+            await process.wait()
 
-    command = f"java -XX:ActiveProcessorCount=1 -Xms512M -Xmx{MAX_RAM} -jar {PATH_CLASSIFIER} classify -t {PATH_RDPCLASSIFIER_DB} -o {output_file} {temp_file}"
-    subprocess.run(command, shell=True, check=True)
+def run_header():
+    """Describe the input and chunk size, to check a run can be resumed."""
+    stat = os.stat(options.infile)
+    return f"#input\t{os.path.abspath(options.infile)}\t{stat.st_size}\t{stat.st_mtime_ns}\t{options.chunksize}\n"
 
-    with lock:
-        progress_counter.value += chunk_size  # Increment by the chunk size
-        pbar.update(min(progress_counter.value, total_lines))
-    return output_file
+def read_manifest(manifest_file):
+    """Return the header, the indices of the chunks a previous run finished and the output size after each merged chunk."""
+    finished = set()
+    merged = {}
+    with open(manifest_file) as f:
+        header = f.readline()
+        for line in f:
+            if not line.endswith("\n"):  # Partly written when the run stopped
+                continue
+            fields = line.rstrip("\n").split("\t")
+            if fields[1] == "done":
+                finished.add(int(fields[0]))
+            elif fields[1] == "merged":
+                merged[int(fields[0])] = int(fields[2])
+    return header, finished, merged
 
-def chunk_file(infile, chunk_size, temp_dir):
-    """Split the file into chunks."""
+def trim_manifest(manifest_file):
+    """Drop a line left partly written when a previous run stopped."""
+    with open(manifest_file, "r+b") as f:
+        f.truncate(f.read().rfind(b"\n") + 1)
+
+def record_chunk(manifest_file, *fields):
+    """Append a chunk's status to the run manifest."""
+    with open(manifest_file, "a") as f:
+        f.write("\t".join(map(str, fields)) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+def to_fasta(chunk_data):
+    """Format a chunk's records, or the byte range of an indexed input, as FASTA bytes for a classifier's stdin."""
+    if isinstance(chunk_data, RecordRange):
+        return seq_index.fasta(chunk_data.start, chunk_data.end).encode()
+    handle = io.StringIO()
+    SeqIO.write(chunk_data, handle, "fasta")
+    return handle.getvalue().encode()
+
+def merge_chunk(out, output_file, compress):
+    """Append a chunk's results to the output, then delete them."""
+    with open(output_file, "rb") as f:
+        data = f.read()
+    if data:
+        out.write(gzip.compress(data) if compress else data)  # One gzip member per chunk
+        out.flush()
+        os.fsync(out.fileno())
+    os.remove(output_file)
+
+def chunk_file(infile, chunk_size, temp_dir, fmt="fasta"):
+    """Split the file into chunks, each with the number of input bytes read so far.
+
+    An indexed input is cut into RecordRanges of chunk_size reads without parsing it."""
+    if seq_index is not None:
+        for first in range(0, len(seq_index), chunk_size):
+            records = seq_index.range(first, min(first + chunk_size, len(seq_index)))
+            yield records, records.end
+        return
     chunk_data = []
-    with open_file(infile, "rt") as f:
-        for record in SeqIO.parse(f, "fasta"):
+    f, raw = open_input(infile)
+    with f:
+        for record in SeqIO.parse(f, fmt):
             chunk_data.append(record)
             if len(chunk_data) >= chunk_size:
-                yield chunk_data
+                yield chunk_data, raw.tell()
                 chunk_data = []
         if chunk_data:  # Yield remaining sequences if any
-            yield chunk_data
+            yield chunk_data, raw.tell()
 
-def count_lines(infile):
-    """Counts the total number of sequences in the input file."""
+def count_lines(infile, fmt="fasta"):
+    """Counts the total number of sequences by scanning raw bytes for record starts (FASTA) or lines (FASTQ)."""
     total_lines = 0
-    with open_file(infile, "rt") as f:
-        for _ in SeqIO.parse(f, "fasta"):
-            total_lines += 1
+    previous = b"\n"
+    with open_file(infile, "rb") as f:
+        while True:
+            block = f.read(COUNT_BLOCK_SIZE)
+            if not block:
+                break
+            if fmt == "fastq":
+                total_lines += block.count(b"\n")
+            else:
+                total_lines += block.count(b"\n>")
+                # A record starting right at the block boundary
+                if previous == b"\n" and block[:1] == b">":
+                    total_lines += 1
+            previous = block[-1:]
+    if fmt == "fastq":
+        # Four lines per record, the last one possibly without its newline
+        return (total_lines + (previous not in (b"", b"\n"))) // 4
     return total_lines
 
-if __name__ == "__main__":
-    manager = Manager()
-    progress_counter = manager.Value('i', 0)
-    lock = manager.Lock()
+async def run_chunks(outfile, compress, temp_dir, manifest_file, finished, merged, num_cpus, chunk_size, fmt="fasta"):
+    """Classify the chunks with at most num_cpus classifiers at once, merging them into outfile in input order.
+
+    One coroutine per chunk feeds its classifier through an asyncio pipe; the input is
+    read only while fewer than QUEUE_DEPTH chunks per classifier are in flight or
+    waiting for an earlier chunk to be merged, so a slow chunk holds back the reader
+    instead of letting finished results pile up in temp_dir. Parsing
+    and formatting chunks run in worker threads, so the event loop keeps feeding and
+    draining the classifiers' pipes meanwhile."""
+    # Long-lived classifiers (--persistent), handed to one chunk at a time. Their JVMs
+    # start before anything is measured, so each gets an equal share of --mem-budget.
+    budget = MemoryBudget(parse_size(options.mem_budget), num_cpus) if options.mem_budget else None
+    heap = f"{max(MIN_HEAP_MB, budget.budget // num_cpus // 2**20)}m" if budget else MAX_RAM
+    persistent = [await start_classifier(heap) for _ in range(num_cpus)] if options.persistent else []
+    classifiers = asyncio.Queue()
+    for classifier in persistent:
+        classifiers.put_nowait(classifier)
+    running = asyncio.Semaphore(num_cpus)
+    slots = asyncio.Semaphore(num_cpus * QUEUE_DEPTH)
+    held = set()  # Chunks holding a slot, which they keep until they are merged
+    ready = {}  # Finished chunks waiting for an earlier one: index -> output file
+    tasks = set()
+    progress = 0
+    next_index = 0
+
+    def count_progress(chunk_end):
+        nonlocal progress
+        progress = max(progress, chunk_end) if options.no_count else progress + chunk_size  # Input bytes read up to the chunk
+        pbar.update(min(progress, total_lines))
+
+    def release_slot(index):
+        if index in held:
+            held.discard(index)
+            slots.release()
+
+    def merge_ready():
+        nonlocal next_index
+        while next_index in merged or next_index in ready:
+            if next_index in ready:
+                merge_chunk(outfile, ready.pop(next_index), compress)
+                record_chunk(manifest_file, next_index, "merged", outfile.tell())
+                release_slot(next_index)
+            next_index += 1
 
-    # Specify the name of the temporary directory
-    temp_dir = "temp"
-    shutil.rmtree(temp_dir, ignore_errors=True)  # Remove directory if it exists
-    os.makedirs(temp_dir)
+    def finish_task(task):
+        # Failed chunks stay in tasks so the reader stops and raises their error
+        if task.cancelled() or task.exception() is None:
+            tasks.discard(task)
+
+    async def process_chunk(chunk_data, chunk_end, index):
+        # Chunk results are named by their index so concurrent classifiers never share one
+        output_file = os.path.join(temp_dir, f"{index}_assigned_taxonomy_rdp_raw.txt")
+        try:
+            fasta = await asyncio.to_thread(to_fasta, chunk_data)
+            async with running:
+                if options.persistent:
+                    classifier = await classifiers.get()
+                    await classify_persistent(classifier, fasta, output_file)
+                    classifiers.put_nowait(classifier)
+                elif budget:
+                    await budget.acquire()
+                    try:
+                        await classify(fasta, output_file, budget.heap())
+                    finally:
+                        await budget.release()
+                else:
+                    await classify(fasta, output_file)
+            record_chunk(manifest_file, index, "done", output_file)
+            count_progress(chunk_end)
+            ready[index] = output_file
+            merge_ready()
+        except BaseException:
+            release_slot(index)  # It will not be merged
+            raise
+
+    try:
+        # Chunks hold chunk_size reads each, so a resumed run cuts the same chunks
+        chunks = chunk_file(options.infile, chunk_size, temp_dir, fmt)
+        index = -1
+        while (next_chunk := await asyncio.to_thread(next, chunks, None)) is not None:
+            chunk, chunk_end = next_chunk
+            index += 1
+            if index in finished:
+                count_progress(chunk_end)
+                if index not in merged:
+                    ready[index] = os.path.join(temp_dir, f"{index}_assigned_taxonomy_rdp_raw.txt")
+                    merge_ready()
+                continue
+            await slots.acquire()
+            held.add(index)
+            failed = [task for task in tasks if task.done() and task.exception()]
+            if failed:
+                raise failed[0].exception()
+            record_chunk(manifest_file, index, "queued", len(chunk))
+            task = asyncio.create_task(process_chunk(chunk, chunk_end, index))
+            tasks.add(task)
+            task.add_done_callback(finish_task)
+            await asyncio.sleep(0)  # Start its classifier before reading on
+        merge_ready()
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for classifier in persistent:
+            if classifier.returncode is None:
+                classifier.kill()
+        raise
+    finally:
+        for classifier in persistent:
+            if classifier.returncode is None:
+                classifier.stdin.close()
+            await classifier.wait()
+
+if __name__ == "__main__":
+    # Per-run temporary directory, kept until the output is complete so the run can be resumed
+    temp_dir = options.temp_dir or options.outfile + ".tmp"
+    manifest_file = os.path.join(temp_dir, "manifest.tsv")
+    header = run_header()
+    finished = set()
+    merged = {}
+    if options.resume and os.path.exists(manifest_file):
+        previous_header, finished, merged = read_manifest(manifest_file)
+        if previous_header != header:
+            print(f"Cannot resume: {temp_dir} belongs to a run with a different input or chunk size.")
+            exit(1)
+        print(f"Resuming: {len(finished)} chunks are already finished.")
+    else:
+        shutil.rmtree(temp_dir, ignore_errors=True)  # Remove directory if it exists
+        os.makedirs(temp_dir)
+        with open(manifest_file, "w") as f:
+            f.write(header)
+    trim_manifest(manifest_file)
 
     # Number of CPUs to use
     num_cpus = int(options.threads)
     chunk_size = int(options.chunksize) # Number of sequences in a chunk
 
-    print(f"Counting the total number of sequences to process...")
-    total_lines = count_lines(options.infile)
-    print(f"Total number of sequences: {total_lines}")
+    # A plain input is indexed once and its chunks read as byte ranges; a gzipped one is parsed
+    fmt = input_format(options.infile)
+    if not is_gzipped(options.infile):
+        print("Indexing the input...")
+        seq_index = SeqIndex(options.infile)
+
+    if options.no_count:
+        # Progress is measured in bytes of the (possibly compressed) input
+        total_lines = os.path.getsize(options.infile)
+    else:
+        if seq_index is None:
+            print(f"Counting the total number of sequences to process...")
+            total_lines = count_lines(options.infile, fmt)
+        else:
+            total_lines = len(seq_index)
+        print(f"Total number of sequences: {total_lines}")
 
     # Start progressbar with total number of lines
     pbar = progressbar.ProgressBar(max_value=total_lines).start()
 
-    pool_args = [(chunk, progress_counter, lock, chunk_size, temp_dir) for chunk in chunk_file(options.infile, chunk_size, temp_dir)]
+    # Merge each chunk into the final output as soon as it and every chunk before
+    # it are done. A resumed run keeps the output up to the last merged chunk.
+    offset = merged[max(merged)] if merged else 0
+    outfile = open(options.outfile, "r+b" if offset else "wb")
+    outfile.truncate(offset)
+    outfile.seek(offset)
+    compress = options.outfile.endswith(".gz")
 
-    with multiprocessing.Pool(processes=num_cpus) as pool:
-        processed_files = pool.starmap(process_chunk, pool_args)
+    with outfile:
+        asyncio.run(run_chunks(outfile, compress, temp_dir, manifest_file, finished, merged, num_cpus, chunk_size, fmt))
 
-    # Merge all processed count files into final output
-    with open(options.outfile, "w") as outfile:
-        subprocess.run(f"cat {' '.join(processed_files)} > {options.outfile}", shell=True, check=True)
-    
     shutil.rmtree(temp_dir, ignore_errors=True)
     
     # Finish
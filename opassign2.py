@@ -2,13 +2,76 @@
 
 import argparse
 import gzip
+import hashlib
+import io
+import json
 import multiprocessing
 import os
+import resource
 import shutil
+import sqlite3
 import subprocess
+import threading
+import time
+import zlib
 from Bio import SeqIO
-from multiprocessing import Manager
+from Bio.SeqRecord import SeqRecord
+from contextlib import contextmanager, nullcontext
+from functools import partial
 import progressbar
+import psutil
+from readfilter import ReadFilter
+from reformatRDPTaxonomy import parse_rank_prefixes, reformat
+from seqindex import BgzfIndex, RecordRange, SeqIndex, file_format, is_bgzf, read_ranges, share_index
+
+# Chunks allowed in flight or awaiting merge per worker: one being classified, one written and waiting
+QUEUE_DEPTH = 2
+
+# With --derep or --cache a chunk is also closed after this many reads per
+# -c sequences, so runs of repeats never pile up in memory
+REPEATS_PER_CHUNK = 10
+
+# With -b, chunk sizes shrink towards the end of the input: each chunk takes at
+# most 1/(TAIL_SPLIT x workers) of the bases estimated to remain, but never less
+# than MIN_CHUNK_FRACTION of -b
+TAIL_SPLIT = 2
+MIN_CHUNK_FRACTION = 1 / 16
+
+# Read size used when counting record starts in the input
+COUNT_BLOCK_SIZE = 16 * 1024 * 1024
+# Compressed bytes inflated at a time by the decompression thread of a gzipped input
+INFLATE_BLOCK_SIZE = 1024 * 1024
+
+# With --mem-budget, a worker reserves the peak RSS measured for its first chunk
+# times MEMORY_HEADROOM, and the JVM heap is capped at that reservation
+MEMORY_HEADROOM = 1.25
+MIN_HEAP_MB = 512
+# The host counts as swapping above this many bytes swapped in per second,
+# checked at most every SWAP_CHECK_INTERVAL seconds
+SWAP_IN_RATE = 1024 * 1024
+SWAP_CHECK_INTERVAL = 1.0
+
+# Seconds between attempts to unblock a results pipe the classifier never opened
+FIFO_RETRY_INTERVAL = 0.01
+
+MAX_RAM = "1000g"
+PATH_CLASSIFIER = "/home/xc917132/applications/rdp_classifier_2.14/dist/classifier.jar"
+PATH_RDPWORKER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rdpworker")
+
+# Long-lived classifier of this worker process (--persistent), and the chunks it has classified
+classifier_proc = None
+classifier_batches = 0
+
+# Byte-offset index of a plain or BGZF input, built before the pool forks so
+# each worker reads (and decompresses) its own chunks from it
+seq_index = None
+
+# Pre-filter applied by each worker to its chunk before classifying it
+read_filter = None
+
+# In-process NumPy model (-e nb), loaded in the parent and shared with forked workers.
+# A compiled model is memory-mapped, so all workers share its pages read-only.
+nb_model = None
 
 def is_gzipped(filename):
     """Check if a file is gzipped."""
@@ -22,79 +85,1027 @@ def open_file(filename, mode='rt'):
     """Open a file in text mode or gzip mode depending on the file type."""
     return gzip.open(filename, mode) if is_gzipped(filename) else open(filename, mode)
 
-def count_lines(infile):
-    """Counts the total number of sequences in the input file."""
-    with open_file(infile, "rt") as f:
-        return sum(1 for _ in SeqIO.parse(f, "fasta"))
+class InflatedReader(io.RawIOBase):
+    """Reads a gzip file that a background thread decompresses into a pipe.
+
+    zlib releases the GIL while it inflates, so decompression overlaps with parsing the
+    records. The pipe and thread are set up on the first read, after the pool has
+    forked, so no worker holds the write end open. A corrupt or truncated file raises
+    at the end of the data, as gzip.open would."""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.error = None
+        self.pipe = None
+        self.thread = None
+
+    def inflate(self, write_fd):
+        try:
+            with open(write_fd, "wb") as out:
+                decompressor = zlib.decompressobj(31)
+                started = False
+                for block in iter(partial(self.raw.read, INFLATE_BLOCK_SIZE), b""):
+                    while block:
+                        started = True
+                        out.write(decompressor.decompress(block))
+                        if not decompressor.eof:
+                            break
+                        # Next member of a multi-member (or BGZF) file
+                        block = decompressor.unused_data
+                        decompressor = zlib.decompressobj(31)
+                        started = False
+                if started:
+                    raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+        except BrokenPipeError:
+            pass  # The reader was closed early
+        except (zlib.error, EOFError) as e:
+            self.error = e
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.thread is None:
+            self.pipe, write_fd = os.pipe()
+            self.thread = threading.Thread(target=self.inflate, args=(write_fd,), daemon=True)
+            self.thread.start()
+        num_bytes = os.readv(self.pipe, [buffer])
+        if num_bytes == 0:
+            self.thread.join()
+            if self.error is not None:
+                raise self.error
+        return num_bytes
+
+    def close(self):
+        if not self.closed and self.pipe is not None:
+            os.close(self.pipe)
+        super().close()
+
+def open_input(filename):
+    """Open the input for streaming; also returns the raw file to report bytes consumed."""
+    raw = open(filename, "rb")
+    if not is_gzipped(filename):
+        return io.TextIOWrapper(raw), raw
+    return io.TextIOWrapper(io.BufferedReader(InflatedReader(raw), INFLATE_BLOCK_SIZE)), raw
+
+def input_format(filename):
+    """fasta or fastq, from the first byte of a plain or gzipped file."""
+    with open_file(filename, "rb") as f:
+        return file_format(f.read(1))
+
+def count_lines(infile, fmt="fasta"):
+    """Counts the total number of sequences by scanning raw bytes for record starts (FASTA) or lines (FASTQ)."""
+    total_lines = 0
+    previous = b"\n"
+    with open_file(infile, "rb") as f:
+        while True:
+            block = f.read(COUNT_BLOCK_SIZE)
+            if not block:
+                break
+            if fmt == "fastq":
+                total_lines += block.count(b"\n")
+            else:
+                total_lines += block.count(b"\n>")
+                # A record starting right at the block boundary
+                if previous == b"\n" and block[:1] == b">":
+                    total_lines += 1
+            previous = block[-1:]
+    if fmt == "fastq":
+        # Four lines per record, the last one possibly without its newline
+        return (total_lines + (previous not in (b"", b"\n"))) // 4
+    return total_lines
+
+def run_header(options, read_filter):
+    """Describes the input, the classifier and the options that decide the chunks and output, to check a run can be resumed."""
+    stat = os.stat(options.infile)
+    return (f"#input\t{os.path.abspath(options.infile)}\t{stat.st_size}\t{stat.st_mtime_ns}\t{options.chunksize}\t{options.chunk_bases}\t{int(bool(options.derep or options.cache))}\t"
+            f"{options.confidence}\t{options.rank_prefixes}\t{int(bool(options.raw))}\t{read_filter}\t{int(bool(options.filter_report))}\t"
+            f"{options.engine}\t{model_identity(options.rdp_db, options.engine)}\n")
+
+def read_manifest(manifest_file):
+    """Returns the header and the chunks of a previous run as
+    {index: [num_reads, (output file, raw output file, filter report), done, merged output sizes]}."""
+    chunks = {}
+    with open(manifest_file) as f:
+        header = f.readline()
+        for line in f:
+            if not line.endswith("\n"):  # Partly written when the run stopped
+                continue
+            fields = line.rstrip("\n").split("\t")
+            if fields[1] == "queued":
+                chunks[int(fields[0])] = [int(fields[2]), None, False, None]
+            elif fields[1] == "done":
+                chunks[int(fields[0])][1:3] = [tuple(field if field != "-" else None for field in fields[2:5]), True]
+            elif fields[1] == "merged":
+                # With --pipe, chunks that were not dereplicated have no "done" line
+                chunks[int(fields[0])][2:4] = [True, [int(field) for field in fields[2:]]]
+    return header, chunks
+
+def trim_manifest(manifest_file):
+    """Drops a line left partly written when a previous run stopped."""
+    with open(manifest_file, "r+b") as f:
+        f.truncate(f.read().rfind(b"\n") + 1)
+
+class ChunkTarget:
+    """Decides when a chunk is full: at -c sequences, or with -b at a number of bases
+    that shrinks towards the end of the input so the last chunks finish together."""
+    
+    def __init__(self, chunk_size, chunk_bases, num_workers, raw, input_size):
+        self.chunk_size = chunk_size
+        self.chunk_bases = chunk_bases
+        self.num_workers = num_workers
+        self.raw = raw
+        self.input_size = input_size
+        self.bases_read = 0
+        self.limit = chunk_bases
+    
+    def full(self, num_seqs, num_bases):
+        if self.chunk_bases is None:
+            return num_seqs >= self.chunk_size
+        return num_bases >= self.limit
+    
+    def next_chunk(self, num_bases):
+        """Sizes the next chunk from the bases the rest of the input is expected to hold."""
+        if self.chunk_bases is None:
+            return
+        self.bases_read += num_bases
+        consumed = self.raw.tell() / self.input_size if self.input_size else 1
+        remaining = self.bases_read * (1 - consumed) / consumed if consumed else self.chunk_bases
+        self.limit = min(self.chunk_bases, max(self.chunk_bases * MIN_CHUNK_FRACTION, remaining / (TAIL_SPLIT * self.num_workers)))
+
+def read_chunks(handle, target, planned=(), fmt="fasta"):
+    """Streams the input and yields lists of records, cut where target says a chunk is full.
+    
+    The first chunks take their sizes from planned, so a resumed run cuts the same chunks."""
+    sizes = iter(planned)
+    planned_reads = next(sizes, None)
+    chunk = []
+    num_bases = 0
+    for record in SeqIO.parse(handle, fmt):
+        chunk.append(record)
+        num_bases += len(record)
+        if planned_reads is not None:
+            full = len(chunk) >= planned_reads
+        else:
+            full = target.full(len(chunk), num_bases)
+        if full:
+            yield chunk
+            target.next_chunk(num_bases)
+            chunk = []
+            num_bases = 0
+            planned_reads = next(sizes, None)
+    if chunk:
+        yield chunk
+
+class ResultCache:
+    """Classifier output lines kept across runs, keyed by model and sequence digest."""
+    
+    def __init__(self, path, model_id, max_entries):
+        # Looked up by the reader, filled in by the merger from the pool's result thread
+        self.connection = sqlite3.connect(path, timeout=600, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.connection.execute("CREATE TABLE IF NOT EXISTS results (model TEXT, digest TEXT, result TEXT, used INTEGER, "
+                                "PRIMARY KEY (model, digest)) WITHOUT ROWID")
+        self.model_id = model_id
+        self.max_entries = max_entries
+        self.stamp = time.time_ns()
+    
+    def get(self, digest):
+        """Returns the cached result line (without the ID) of a sequence, or None."""
+        with self.lock:
+            row = self.connection.execute("SELECT result FROM results WHERE model = ? AND digest = ?", (self.model_id, digest)).fetchone()
+        return row[0] if row else None
+    
+    def put(self, results):
+        """Stores (digest, result) pairs and marks them as used by this run."""
+        with self.lock:
+            self.connection.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                                        ((self.model_id, digest, result, self.stamp) for digest, result in results))
+            self.connection.commit()
+    
+    def evict(self):
+        """Drops the least recently used entries above the size cap."""
+        excess = self.connection.execute("SELECT COUNT(*) FROM results").fetchone()[0] - self.max_entries
+        if excess > 0:
+            self.connection.execute("DELETE FROM results WHERE (model, digest) IN "
+                                    "(SELECT model, digest FROM results ORDER BY used LIMIT ?)", (excess,))
+            self.connection.commit()
+
+def model_identity(rdp_db, engine):
+    """Identifies a classifier model by its -d path and files.
+    
+    For rdp that is the content of rRNAClassifier.properties and the size and mtime of
+    the model files it names; a compiled nb model, which can be several GB, is identified
+    by its size and mtime alone."""
+    digest = hashlib.sha256(f"{engine}\t{os.path.abspath(rdp_db)}\n".encode())
+    model_files = [rdp_db]
+    if engine == "rdp":
+        with open(rdp_db, "rb") as f:
+            properties = f.read()
+        digest.update(properties)
+        # key=value lines; the trained model files are named relative to the properties file
+        directory = os.path.dirname(os.path.abspath(rdp_db))
+        model_files = []
+        for line in properties.decode(errors="replace").splitlines():
+            key, _, value = line.partition("=")
+            path = os.path.join(directory, value.strip())
+            if not line.lstrip().startswith(("#", "!")) and value.strip() and os.path.isfile(path):
+                model_files.append(path)
+    for path in model_files:
+        stat = os.stat(path)
+        digest.update(f"{os.path.basename(path)}\t{stat.st_size}\t{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+def read_unique_chunks(handle, target, cache=None, planned=(), fmt="fasta", read_filter=None):
+    """Streams the input and yields chunks of distinct sequences, cut where target says a chunk is full.
+    
+    Each distinct sequence is sent once, named by its digest, together with the
+    (read ID, digest, pre-filter note) of every read consumed since the previous
+    chunk and the (digest, result) of sequences found in the cache instead. The
+    pre-filter runs here on every read: a removed read has no digest, and a trimmed
+    one is dereplicated and cached by its trimmed sequence. The first chunks take
+    their number of reads from planned, so a resumed run cuts the same chunks."""
+    sizes = iter(planned)
+    planned_reads = next(sizes, None)
+    seen = set()
+    chunk, order, hits = [], [], []
+    num_bases = 0
+    for record in SeqIO.parse(handle, fmt):
+        reason = read_filter.reason(str(record.seq)) if read_filter else None
+        if reason is not None:
+            order.append((record.id, "-", f"{reason}\t{len(record)}"))
+        else:
+            seq, note = record.seq, None
+            if read_filter and read_filter.trim_length is not None and len(seq) > read_filter.trim_length:
+                seq, note = seq[:read_filter.trim_length], f"trimmed\t{len(record)}"
+            digest = hashlib.blake2b(str(seq).upper().encode(), digest_size=16).hexdigest()
+            order.append((record.id, digest, note))
+            if digest not in seen:
+                seen.add(digest)
+                result = cache.get(digest) if cache else None
+                if result is None:
+                    chunk.append(SeqRecord(seq, id=digest, description=""))
+                    num_bases += len(seq)
+                else:
+                    hits.append((digest, result))
+        if planned_reads is not None:
+            full = len(order) >= planned_reads
+        else:
+            full = target.full(len(chunk), num_bases) or len(order) >= target.chunk_size * REPEATS_PER_CHUNK
+        if full:
+            yield chunk, order, hits
+            target.next_chunk(num_bases)
+            chunk, order, hits = [], [], []
+            num_bases = 0
+            planned_reads = next(sizes, None)
+    if chunk or order:
+        yield chunk, order, hits
+
+def parse_size(text):
+    """Bytes in a size such as 500m or 64g."""
+    units = {"k": 2**10, "m": 2**20, "g": 2**30, "t": 2**40}
+    text = text.strip().lower().rstrip("b")
+    if text[-1:] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+class MemoryBudget:
+    """Limits the chunks classified at once so the workers' measured memory fits in a budget (--mem-budget).
+    
+    The first chunk runs alone and its peak RSS, less the pages shared between workers,
+    sets each worker's reservation and JVM heap. Fewer chunks are started while the host swaps."""
+    
+    def __init__(self, budget, num_workers):
+        self.budget = budget
+        self.num_workers = num_workers
+        self.reserve = None  # Bytes per running chunk; None until the first chunk is measured
+        self.shared = 0  # Pages all workers share, such as the memory-mapped -e nb model, counted once
+        self.heap_mb = None
+        self.running = 0
+        self.cap = num_workers  # Lowered while the host swaps
+        self.condition = threading.Condition()
+        self.last_check = time.time()
+        self.swapped_in = psutil.swap_memory().sin
+    
+    def limit(self):
+        if self.reserve is None:
+            return 1
+        fits = int((self.budget - self.shared) // self.reserve)
+        return max(1, min(self.num_workers, fits, self.cap))
+    
+    def heap(self):
+        """JVM -Xmx for the next chunk: the whole budget for the first one, then the reservation."""
+        return f"{self.heap_mb or max(MIN_HEAP_MB, self.budget // 2**20)}m"
+    
+    def check_swap(self):
+        now = time.time()
+        if now - self.last_check < SWAP_CHECK_INTERVAL:
+            return
+        swapped_in = psutil.swap_memory().sin
+        if (swapped_in - self.swapped_in) / (now - self.last_check) > SWAP_IN_RATE:
+            self.cap = max(1, min(self.cap, self.running) - 1)
+        elif self.cap < self.num_workers:
+            self.cap += 1
+        self.last_check, self.swapped_in = now, swapped_in
+    
+    def acquire(self):
+        """Waits until one more chunk fits; returns the number allowed at once."""
+        with self.condition:
+            self.check_swap()
+            while self.running >= self.limit():
+                self.condition.wait(SWAP_CHECK_INTERVAL)
+                self.check_swap()
+            self.running += 1
+            return self.limit()
+    
+    def release(self, events=()):
+        with self.condition:
+            for event in events:
+                if "rss_mb" in event:
+                    shared = event.get("shared_mb", 0.0) * 2**20
+                    private = event["rss_mb"] * 2**20 - shared
+                    if self.reserve is None:
+                        self.reserve = private * MEMORY_HEADROOM
+                        self.heap_mb = max(MIN_HEAP_MB, int(self.reserve // 2**20))
+                        if self.reserve + shared > self.budget:
+                            print(f"A worker needs {(self.reserve + shared) / 2**30:.1f} GB, over --mem-budget; running one at a time.")
+                    # The heap stays fixed, so later, larger chunks only raise the reservation
+                    self.reserve = max(self.reserve, private)
+                    self.shared = max(self.shared, shared)
+            self.running -= 1
+            self.condition.notify_all()
+
+def timed_event(name, start, cpu_start, cpu_clock=time.process_time, **fields):
+    """A metrics event: wall time since start and CPU time since cpu_start on cpu_clock, then fields."""
+    return {"name": name, "start": round(start, 6), "wall_s": round(time.time() - start, 6),
+            "cpu_s": round(cpu_clock() - cpu_start, 6), "pid": os.getpid(), "tid": threading.get_native_id(), **fields}
+
+class Metrics:
+    """Timed events of the run, written as JSON lines (--metrics) and Chrome trace events (--trace)."""
+    
+    def __init__(self, metrics_file=None, trace_file=None):
+        self.enabled = bool(metrics_file or trace_file)
+        self.out = open(metrics_file, "w") if metrics_file else None
+        self.trace_file = trace_file
+        self.events = []
+        self.lock = threading.Lock()
+    
+    def add(self, events):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.events.extend(events)
+            if self.out:
+                self.out.writelines(json.dumps(event) + "\n" for event in events)
+                self.out.flush()
+    
+    @contextmanager
+    def stage(self, name, **fields):
+        """Times the enclosed block on this thread; keys set in the yielded dict are recorded with it."""
+        start, cpu = time.time(), time.thread_time()
+        yield fields
+        if self.enabled:
+            self.add([timed_event(name, start, cpu, time.thread_time, **fields)])
+    
+    def summary(self, start, num_reads, num_workers):
+        """Prints and records throughput, worker utilisation and the time spent in each stage."""
+        wall = time.time() - start
+        stages = {}
+        for event in self.events:
+            stages[event["name"]] = stages.get(event["name"], 0.0) + event["wall_s"]
+        num_bases = sum(event.get("bases", 0) for event in self.events if event["name"] == "read")
+        utilisation = stages.get("classify", 0.0) / (num_workers * wall) if wall else 0.0
+        summary = {"name": "summary", "start": round(start, 6), "wall_s": round(wall, 3), "reads": num_reads,
+                   "bases_classified": num_bases, "reads_per_s": round(num_reads / wall, 1), "bases_per_s": round(num_bases / wall, 1),
+                   "workers": num_workers, "worker_utilisation": round(utilisation, 3),
+                   "stages_s": {name: round(seconds, 3) for name, seconds in stages.items()}}
+        self.add([summary])
+        print(f"Run time {wall:.1f} s: {num_reads} reads ({summary['reads_per_s']} reads/s), "
+              f"{num_bases} bases classified ({summary['bases_per_s']} bases/s)")
+        print(f"Worker utilisation: {utilisation:.0%} of {num_workers} workers")
+        print("Time by stage (s): " + ", ".join(f"{name} {seconds:.1f}" for name, seconds in stages.items()))
+    
+    def close(self):
+        if self.out:
+            self.out.close()
+        if self.trace_file:
+            # Complete ("X") events in microseconds from the start of the run
+            spans = [event for event in self.events if event["name"] != "summary"]
+            origin = min((event["start"] for event in spans), default=0)
+            trace = [{"name": event["name"], "cat": "chunk" if "chunk" in event else "stage", "ph": "X",
+                      "ts": round((event["start"] - origin) * 1e6), "dur": round(event["wall_s"] * 1e6),
+                      "pid": event["pid"], "tid": event["tid"],
+                      "args": {key: value for key, value in event.items() if key not in ("name", "start", "wall_s", "pid", "tid")}}
+                     for event in spans]
+            for pid in sorted({event["pid"] for event in spans}):
+                name = "opassign2" if pid == os.getpid() else f"worker {pid}"
+                trace.append({"name": "process_name", "ph": "M", "pid": pid, "args": {"name": name}})
+            summary = [event for event in self.events if event["name"] == "summary"]
+            with open(self.trace_file, "w") as f:
+                json.dump({"traceEvents": trace, "displayTimeUnit": "ms", "otherData": summary[-1] if summary else {}}, f)
+
+def timed_chunks(chunks, metrics):
+    """Passes chunks through, recording the time spent parsing the input for each."""
+    index = 0
+    while True:
+        start, cpu = time.time(), time.thread_time()
+        chunk = next(chunks, None)
+        if chunk is None:
+            return
+        index += 1
+        if metrics.enabled:
+            records, order, hits = chunk
+            bases = records.bases if isinstance(records, RecordRange) else sum(len(record) for record in records)
+            metrics.add([timed_event("read", start, cpu, time.thread_time, chunk=index,
+                                     reads=len(records) if order is None else len(order), bases=bases)])
+        yield chunk
 
-def process_chunk(chunk_file, temp_file_prefix_cpu, temp_dir, chunk_size, progress_counter, lock):
-    """Runs a shell command to classify sequences in a chunk and then deletes the chunk."""
-    output_file = os.path.join(temp_dir, f"{temp_file_prefix_cpu}_assigned_taxonomy_rdp_raw.txt")
+class OrderedMerger:
+    """Appends finished chunks to the outputs in input order.
+    
+    Chunks that finish early wait in a reorder buffer of file names, or with --pipe
+    of their results themselves. A chunk keeps its dispatch slot until it is merged,
+    so the buffer never holds more than -t x QUEUE_DEPTH chunks. Each merged chunk is recorded in the manifest with the output sizes, so a resumed
+    run can truncate the outputs there and carry on. A chunk's processed files are
+    its output, with --confidence and --raw the raw classifier results, and with
+    --filter-report the pre-filter report; columns says which of them each output takes.
+    on_merge is called with each chunk's index once it is merged."""
+    
+    def __init__(self, outfiles, offsets, record_chunk, cache=None, reformat=None, metrics=None, columns=None, on_merge=None):
+        self.compress = [outfile.endswith(".gz") for outfile in outfiles]  # One gzip member per chunk
+        self.outs = []
+        for outfile, offset in zip(outfiles, offsets):
+            out = open(outfile, "r+b" if offset else "wb")
+            out.truncate(offset)
+            out.seek(offset)
+            self.outs.append(out)
+        self.columns = columns or list(range(len(outfiles)))
+        self.record_chunk = record_chunk
+        self.cache = cache
+        self.reformat = reformat  # --confidence: applied to cached results, which are stored raw
+        self.metrics = metrics or Metrics()
+        self.on_merge = on_merge
+        self.next_index = 1
+        self.waiting = {}
+        self.results = [{} for out in self.outs]  # --derep: digest -> result of every distinct sequence so far, per output
+        self.lock = threading.Lock()
+    
+    def add(self, index, processed_files, order_file=None, hit_file=None):
+        """Takes a finished chunk and merges every chunk that is now next in line."""
+        with self.lock:
+            self.waiting[index] = (processed_files, order_file, hit_file)
+            while self.next_index in self.waiting:
+                self.merge(self.next_index, *self.waiting.pop(self.next_index))
+                self.next_index += 1
+    
+    def skip(self, index, processed_files, hit_file, dereplicated):
+        """Accounts for a chunk that a previous run already merged."""
+        with self.lock:
+            if dereplicated:
+                for results, chunk_results in zip(self.results, self.read_chunk_results(processed_files, hit_file)[0]):
+                    results.update(chunk_results)
+            self.next_index = index + 1
     
-    MAX_RAM = "1000g"
-    PATH_CLASSIFIER = "/home/xc917132/applications/rdp_classifier_2.14/dist/classifier.jar"
-    #PATH_RDPCLASSIFIER_DB = "/home/xc917132/applications/rdp_db/GROND_trained_207/GROND_retrained/rRNAClassifier.properties"
-    PATH_RDPCLASSIFIER_DB = options.rdp_db
+    def read_chunk_results(self, processed_files, hit_file):
+        """Returns a dereplicated chunk's (digest, result) pairs for each output, and its raw ones."""
+        output_file, raw_file = processed_files[:2] if self.reformat else (None, processed_files[0])
+        hits = read_results(hit_file) if hit_file else []
+        raw_results = (read_results(raw_file) if raw_file else []) + hits
+        if not self.reformat:
+            columns = [raw_results, None, []]
+        else:
+            formatted = [self.reformat(digest + "\t" + result).split("\t", 1) for digest, result in hits]
+            columns = [(read_results(output_file) if output_file else []) + formatted, raw_results, []]
+        return [columns[column] for column in self.columns], raw_results
     
-    command = f"java -Xms512M -Xmx{MAX_RAM} -jar {PATH_CLASSIFIER} classify -t {PATH_RDPCLASSIFIER_DB} -o {output_file} {chunk_file}"
-    subprocess.run(command, shell=True, check=True)
+    def merge(self, index, processed_files, order_file, hit_file):
+        with self.metrics.stage("merge", chunk=index) as fields:
+            fields["bytes"] = self.merge_chunk(index, processed_files, order_file, hit_file)
+        if self.on_merge:
+            self.on_merge(index)
     
-    with lock:
-        progress_counter.value += chunk_size
-        pbar.update(min(progress_counter.value, total_lines))
+    def merge_chunk(self, index, processed_files, order_file, hit_file):
+        if order_file is None:
+            blocks = []
+            for column in self.columns:
+                processed_file = processed_files[column]
+                if processed_file is None or isinstance(processed_file, bytes):
+                    blocks.append(processed_file or b"")
+                    continue
+                with open(processed_file, "rb") as f:
+                    blocks.append(f.read())
+            for processed_file in processed_files:
+                if isinstance(processed_file, str):
+                    os.remove(processed_file)
+        else:
+            # A read's sequence is always classified in its own chunk or an earlier one
+            chunk_results, raw_results = self.read_chunk_results(processed_files, hit_file)
+            if self.cache:
+                self.cache.put(raw_results)
+            for results, new_results in zip(self.results, chunk_results):
+                results.update(new_results)
+            lines = [[] for out in self.outs]
+            with open(order_file) as f:
+                for line in f:
+                    read_id, digest, *note = line.rstrip("\n").split("\t", 2)
+                    for output_lines, results, column in zip(lines, self.results, self.columns):
+                        if column == 2:  # Filter report: the notes the reader wrote for each read
+                            output_lines.extend(f"{read_id}\t{text}\n" for text in note)
+                        elif digest in results:  # Sequences the classifier skipped stay skipped
+                            output_lines.append(read_id + "\t" + results[digest])
+            blocks = ["".join(output_lines).encode() for output_lines in lines]
+            # The distinct sequences' results stay until the end of the run: later reads may repeat them
+            os.remove(order_file)
+        for out, compress, data in zip(self.outs, self.compress, blocks):
+            if data:
+                out.write(gzip.compress(data) if compress else data)
+                out.flush()
+                os.fsync(out.fileno())
+        self.record_chunk(index, "merged", *(out.tell() for out in self.outs))
+        return sum(len(data) for data in blocks)
     
-    os.remove(chunk_file)  # Delete the chunk after processing
-    return output_file
+    def close(self):
+        for out in self.outs:
+            out.close()
+
+def read_results(results):
+    """Returns the (digest, result) pairs of a classifier output named by digests, from its file or (--pipe) its bytes."""
+    if isinstance(results, bytes):
+        return [line.split("\t", 1) for line in results.decode().splitlines(keepends=True)]
+    with open(results) as f:
+        return [line.split("\t", 1) for line in f]
+
+def start_classifier(rdp_db, heap):
+    """Starts a long-lived RDP Classifier for this worker process."""
+    global classifier_proc
+    command = ["java", f"-Xms{min(MIN_HEAP_MB, parse_size(heap) // 2**20)}M", f"-Xmx{heap}", "-cp", f"{PATH_CLASSIFIER}{os.pathsep}{PATH_RDPWORKER}", "RDPWorker", rdp_db]
+    # A failing pool initializer makes the pool respawn workers forever,
+    # so keep the error and report it from the first chunk instead
+    try:
+        classifier_proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+    except OSError as error:
+        classifier_proc = error
+
+def classify_persistent(chunk, out):
+    """Streams a chunk through the worker's classifier and writes its results."""
+    if isinstance(classifier_proc, OSError):
+        raise classifier_proc
+    shutil.copyfileobj(chunk, classifier_proc.stdin)
+    classifier_proc.stdin.write("\n//\n")
+    classifier_proc.stdin.flush()
+    for line in classifier_proc.stdout:
+        if line == "//\n":
+            return
+        out.write(line)
+    raise RuntimeError(f"RDP Classifier worker exited with code {classifier_proc.wait()}")
+
+def classify_nb(chunk, out):
+    """Classifies a chunk with the in-process naive Bayesian classifier."""
+    records = [(record.id, str(record.seq)) for record in SeqIO.parse(chunk, "fasta")]
+    out.writelines(rdpnb.classify(nb_model, records))
+
+def run_classifier(command, fasta=None, fifo=None):
+    """Runs one RDP Classifier JVM and returns its resource usage, and with --pipe its output.
+    
+    A chunk given as fasta is written to the JVM's stdin, and with fifo its results
+    are read back through that named pipe, so neither touches the disk."""
+    output = []
+
+    def read_fifo():
+        with open(fifo, "rb") as results:
+            output.append(results.read())
+
+    if fifo:
+        if os.path.exists(fifo):  # Left by a run that was stopped
+            os.remove(fifo)
+        os.mkfifo(fifo)
+        reader = threading.Thread(target=read_fifo)
+        reader.start()
+    process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE if fasta is not None else None)
+    if fasta is not None:
+        try:
+            with process.stdin:
+                process.stdin.write(fasta.encode())
+        except BrokenPipeError:  # The JVM failed; its exit code says why
+            pass
+    # wait4 gives the CPU time and peak RSS of this JVM alone
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if fifo:
+        # If the JVM never opened the pipe, open its other end so the reader returns.
+        # That fails (ENXIO) until the reader has opened its own end, so keep trying.
+        while reader.is_alive():
+            try:
+                os.close(os.open(fifo, os.O_WRONLY | os.O_NONBLOCK))
+            except OSError:
+                pass
+            reader.join(FIFO_RETRY_INTERVAL)
+        os.remove(fifo)
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, command)
+    return usage, b"".join(output).decode()
+
+def process_chunk(chunk, temp_file_prefix_cpu, temp_dir, index, submitted, heap=MAX_RAM):
+    """Runs a shell command to classify sequences in a chunk and then deletes the chunk.
+    
+    Returns the chunk's output file, with --confidence its raw classifier results if
+    still needed, and the pre-filter report if it has one, together with the chunk's
+    metrics events. With --pipe the chunk is its FASTA text and the results are
+    returned as bytes instead of files. A chunk of an indexed input is its (start, end)
+    byte range, read here."""
+    global classifier_batches
+    piped = options.pipe
+    in_memory = piped
+    if isinstance(chunk, tuple):
+        chunk = seq_index.fasta(*chunk)
+        in_memory = True
+    chunk_file = None if in_memory else chunk
+    output_file = None if piped else os.path.join(temp_dir, f"{temp_file_prefix_cpu}_assigned_taxonomy_rdp_raw.txt")
+    events = []
+    report = None
+    
+    if read_filter and not (options.derep or options.cache):
+        # The classifier then reads the kept reads from memory. Dereplicated
+        # chunks were filtered read by read as they were read.
+        start, cpu = time.time(), time.process_time()
+        if chunk_file is not None:
+            with open_file(chunk_file, "rt") as f:
+                chunk = f.read()
+            in_memory = True
+        chunk, filtered = read_filter.filter_fasta(chunk)
+        counts = {}
+        for read_id, reason, length in filtered:
+            counts[reason] = counts.get(reason, 0) + 1
+        events.append(timed_event("filter", start, cpu, chunk=index, filtered=counts))
+        if filtered:
+            report = "".join(f"{read_id}\t{reason}\t{length}\n" for read_id, reason, length in filtered).encode()
+            if not piped:
+                report_file = os.path.join(temp_dir, f"{temp_file_prefix_cpu}_filtered.txt")
+                with open(report_file, "wb") as f:
+                    f.write(report)
+                report = report_file
+    
+    start, cpu = time.time(), time.process_time()
+    fields = {"chunk": index, "engine": options.engine, "queue_wait_s": round(start - submitted, 6)}
+    
+    if not chunk:  # The pre-filter removed every read
+        raw = ""
+        if not piped:
+            open(output_file, "w").close()
+    elif options.engine == "rdp" and not options.persistent:
+        #PATH_RDPCLASSIFIER_DB = "/home/xc917132/applications/rdp_db/GROND_trained_207/GROND_retrained/rRNAClassifier.properties"
+        PATH_RDPCLASSIFIER_DB = options.rdp_db
+        fifo = os.path.join(temp_dir, f"{temp_file_prefix_cpu}.fifo") if piped else None
+        command = (f"java -Xms{min(MIN_HEAP_MB, parse_size(heap) // 2**20)}M -Xmx{heap} -jar {PATH_CLASSIFIER} classify -t {PATH_RDPCLASSIFIER_DB} "
+                   f"-o {fifo or output_file} {'/dev/stdin' if in_memory else chunk}")
+        usage, raw = run_classifier(command, chunk if in_memory else None, fifo)
+        fields.update(cpu_s=round(usage.ru_utime + usage.ru_stime, 6), rss_mb=usage.ru_maxrss / 1024)
+    else:
+        with (io.StringIO(chunk) if in_memory else open_file(chunk, "rt")) as f, (io.StringIO() if piped else open(output_file, "w")) as out:
+            if options.engine == "nb":
+                classify_nb(f, out)
+                fields.update(rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                              shared_mb=psutil.Process().memory_info().shared / 2**20)
+            else:
+                jvm = psutil.Process(classifier_proc.pid) if not isinstance(classifier_proc, OSError) else None
+                jvm_cpu = sum(jvm.cpu_times()[:2]) if jvm else 0.0
+                classify_persistent(f, out)
+                classifier_batches += 1
+                # The JVM's first batch includes its start-up and model load
+                fields.update(first_batch=classifier_batches == 1, cpu_s=round(sum(jvm.cpu_times()[:2]) - jvm_cpu, 6),
+                              rss_mb=jvm.memory_info().rss / 2**20, shared_mb=jvm.memory_info().shared / 2**20)
+            raw = out.getvalue() if piped else None
+    events.append(timed_event("classify", start, cpu, **fields))
+    
+    if piped:
+        if options.confidence is None:
+            return (raw.encode(), None, report), events
+        start, cpu = time.time(), time.process_time()
+        taxonomy = "".join(reformat(line, threshold, rank_prefixes) for line in raw.splitlines(keepends=True))
+        events.append(timed_event("reformat", start, cpu, chunk=index))
+        return (taxonomy.encode(), raw.encode() if keep_raw else None, report), events
+    
+    if chunk_file is not None:
+        os.remove(chunk_file)  # Delete the chunk after processing
+    
+    if options.confidence is None:
+        return (output_file, None, report), events
+    # Filter and reformat here rather than in a serial pass over the whole output afterwards
+    start, cpu = time.time(), time.process_time()
+    taxonomy_file = os.path.join(temp_dir, f"{temp_file_prefix_cpu}_assigned_taxonomy.txt")
+    with open(output_file) as f, open(taxonomy_file, "w") as out:
+        out.writelines(reformat(line, threshold, rank_prefixes) for line in f)
+    if not keep_raw:
+        os.remove(output_file)
+        output_file = None
+    events.append(timed_event("reformat", start, cpu, chunk=index))
+    return (taxonomy_file, output_file, report), events
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser("RDP Classifier - multiple CPUs")
     parser.add_argument("-i", required=True, dest="infile", metavar="infile", help="[REQUIRED]")
     parser.add_argument("-o", required=True, dest="outfile", metavar="outfile", help="[REQUIRED]")
     parser.add_argument("-c", dest="chunksize", metavar="chunksize", help="[OPTIONAL] Chunk size", default="1000")
+    parser.add_argument("-b", dest="chunk_bases", metavar="chunk_bases", help="[OPTIONAL] Cut chunks by total bases instead of -c sequences; chunks shrink towards the end of the input")
     parser.add_argument("-t", required=True, dest="threads", metavar="threads", help="[REQUIRED]")
-    parser.add_argument("-d", required=True, dest="rdp_db", metavar="rdp_db", help="[REQUIRED]")
+    parser.add_argument("-d", required=True, dest="rdp_db", metavar="rdp_db", help="[REQUIRED] rRNAClassifier.properties, or the compiled model or training FASTA with -e nb")
+    parser.add_argument("-e", dest="engine", metavar="engine", choices=["rdp", "nb"], help="[OPTIONAL] Classifier: rdp (RDP Classifier in Java) or nb (in-process NumPy)", default="rdp")
+    parser.add_argument("--persistent", action="store_true", dest="persistent", help="[OPTIONAL] Keep one RDP Classifier JVM per worker and load the model only once")
+    parser.add_argument("--derep", action="store_true", dest="derep", help="[OPTIONAL] Classify each distinct sequence once and copy the result to every read with it")
+    parser.add_argument("--cache", dest="cache", metavar="cache", help="[OPTIONAL] SQLite file of classifications reused across runs with the same model")
+    parser.add_argument("--cache-size", dest="cache_size", metavar="cache_size", help="[OPTIONAL] Maximum number of sequences kept in the cache", default="10000000")
+    parser.add_argument("--confidence", dest="confidence", metavar="confidence", help="[OPTIONAL] Write the taxonomy as reformatRDPTaxonomy.py does, keeping ranks down to this minimum confidence")
+    parser.add_argument("--rank-prefixes", dest="rank_prefixes", metavar="rank_prefixes", help="[OPTIONAL] With --confidence, comma-separated rank=prefix pairs added to or replacing the defaults, e.g. strain=t__")
+    parser.add_argument("--raw", dest="raw", metavar="raw", help="[OPTIONAL] With --confidence, also write the raw classifier output to this file")
+    parser.add_argument("--min-length", dest="min_length", metavar="min_length", help="[OPTIONAL] Pre-filter: drop reads shorter than this many bases")
+    parser.add_argument("--max-length", dest="max_length", metavar="max_length", help="[OPTIONAL] Pre-filter: drop reads longer than this many bases")
+    parser.add_argument("--max-n-fraction", dest="max_n_fraction", metavar="max_n_fraction", help="[OPTIONAL] Pre-filter: drop reads with a larger fraction of N bases, e.g. 0.05")
+    parser.add_argument("--max-homopolymer", dest="max_homopolymer", metavar="max_homopolymer", help="[OPTIONAL] Pre-filter: drop reads with a homopolymer run longer than this")
+    parser.add_argument("--min-entropy", dest="min_entropy", metavar="min_entropy", help="[OPTIONAL] Pre-filter: drop low-complexity reads whose trinucleotide entropy (0-1) is below this, e.g. 0.5")
+    parser.add_argument("--trim-length", dest="trim_length", metavar="trim_length", help="[OPTIONAL] Pre-filter: cut reads longer than this many bases down to it")
+    parser.add_argument("--filter-report", dest="filter_report", metavar="filter_report", help="[OPTIONAL] Write the ID, filter and length of every read the pre-filter removed or trimmed to this file")
+    parser.add_argument("--pipe", action="store_true", dest="pipe", help="[OPTIONAL] Hand chunks to the classifiers and results back through pipes instead of files in the temp directory")
+    parser.add_argument("--temp-dir", dest="temp_dir", metavar="temp_dir", help="[OPTIONAL] Directory for chunk files and the run manifest (default: <outfile>.tmp)")
+    parser.add_argument("--resume", action="store_true", dest="resume", help="[OPTIONAL] Reuse the chunks a previous run of the same command finished")
+    parser.add_argument("--mem-budget", dest="mem_budget", metavar="mem_budget", help="[OPTIONAL] Memory for all classifiers together, e.g. 200g: sizes each JVM heap and runs fewer than -t chunks at once if they would not fit")
+    parser.add_argument("--metrics", dest="metrics", metavar="metrics", help="[OPTIONAL] Write the time, CPU, reads, bases and RSS of every chunk and stage to this JSON lines file")
+    parser.add_argument("--trace", dest="trace", metavar="trace", help="[OPTIONAL] Write the same events in Chrome trace format (chrome://tracing, Perfetto)")
+    parser.add_argument("--no-count", action="store_true", dest="no_count", help="[OPTIONAL] Skip counting sequences and show progress by input bytes read")
     options = parser.parse_args()
+    run_start = time.time()
+    metrics = Metrics(options.metrics, options.trace)
+    if options.raw and options.confidence is None:
+        parser.error("--raw needs --confidence")
+    
+    read_filter = ReadFilter(
+        min_length=int(options.min_length) if options.min_length else None,
+        max_length=int(options.max_length) if options.max_length else None,
+        max_n_fraction=float(options.max_n_fraction) if options.max_n_fraction else None,
+        max_homopolymer=int(options.max_homopolymer) if options.max_homopolymer else None,
+        min_entropy=float(options.min_entropy) if options.min_entropy else None,
+        trim_length=int(options.trim_length) if options.trim_length else None)
+    if options.filter_report and not read_filter:
+        parser.error("--filter-report needs at least one pre-filter option")
     
-    manager = Manager()
-    progress_counter = manager.Value('i', 0)
-    lock = manager.Lock()
-    temp_dir = "temp"
-    shutil.rmtree(temp_dir, ignore_errors=True)
-    os.makedirs(temp_dir)
+    # Per-run temp directory, kept until the output is complete so the run can be resumed
+    temp_dir = options.temp_dir or options.outfile + ".tmp"
+    manifest_file = os.path.join(temp_dir, "manifest.tsv")
+    header = run_header(options, read_filter)
+    finished = {}
+    if options.resume and os.path.exists(manifest_file):
+        previous_header, finished = read_manifest(manifest_file)
+        if previous_header != header:
+            print(f"Cannot resume: {temp_dir} belongs to a run with a different input, classifier or chunk options.")
+            exit(1)
+        print(f"Resuming: {sum(chunk[2] for chunk in finished.values())} of {len(finished)} recorded chunks are finished.")
+    else:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        os.makedirs(temp_dir)
+        with open(manifest_file, "w") as manifest:
+            manifest.write(header)
+    trim_manifest(manifest_file)
+    manifest = open(manifest_file, "a")
+    manifest_lock = threading.Lock()
+    
+    def record_chunk(*fields):
+        with manifest_lock:
+            manifest.write("\t".join(map(str, fields)) + "\n")
+            manifest.flush()
+            os.fsync(manifest.fileno())
     
     num_cpus = int(options.threads)
     chunk_size = int(options.chunksize)
+    chunk_bases = int(options.chunk_bases) if options.chunk_bases else None
+    
+    if options.engine == "nb":
+        import rdpnb
+        print("Loading the naive Bayesian classifier...")
+        with metrics.stage("load_model"):
+            nb_model = rdpnb.load_model(options.rdp_db)
+    
+    # A plain or BGZF input is indexed once and cut into byte ranges that the workers
+    # read themselves. --derep and --cache need every sequence in this process instead.
+    fmt = input_format(options.infile)
+    if not (options.derep or options.cache) and (is_bgzf(options.infile) or not is_gzipped(options.infile)):
+        print("Indexing the input...")
+        with metrics.stage("index"):
+            if is_bgzf(options.infile):
+                # The block table comes from the headers; workers decompress and scan the blocks
+                seq_index = BgzfIndex(options.infile)
+                with multiprocessing.Pool(processes=num_cpus, initializer=share_index, initargs=(seq_index,)) as index_pool:
+                    seq_index.index_records(index_pool.imap)
+            else:
+                seq_index = SeqIndex(options.infile)
     
-    print("Counting the total number of sequences to process...")
-    total_lines = count_lines(options.infile)
-    print(f"Total number of sequences to process: {total_lines}")
+    if options.no_count:
+        # Progress is measured in bytes of the input (uncompressed if it is indexed)
+        total_lines = seq_index.size if seq_index is not None else os.path.getsize(options.infile)
+    else:
+        if seq_index is None:
+            print("Counting the total number of sequences to process...")
+            with metrics.stage("count"):
+                total_lines = count_lines(options.infile, fmt)
+        else:
+            total_lines = len(seq_index)
+        print(f"Total number of sequences to process: {total_lines}")
     
     pbar = progressbar.ProgressBar(max_value=total_lines).start()
     
-    processed_files = []
-    with open_file(options.infile, "rt") as f:
-        records = list(SeqIO.parse(f, "fasta"))
+    # The cache works on distinct sequences, so it implies --derep
+    cache = None
+    if options.cache:
+        cache = ResultCache(options.cache, model_identity(options.rdp_db, options.engine), int(options.cache_size))
+    dereplicate = options.derep or cache is not None
+    
+    # With --confidence the workers write the reformatted taxonomy. The raw results
+    # are kept for --raw and for the cache, which stores them unfiltered.
+    outfiles = [options.outfile]
+    reformat_result = None
+    if options.confidence is not None:
+        threshold = float(options.confidence)
+        rank_prefixes = parse_rank_prefixes(options.rank_prefixes)
+        keep_raw = bool(options.raw) or cache is not None
+        reformat_result = partial(reformat, threshold=threshold, prefixes=rank_prefixes)
+        if options.raw:
+            outfiles.append(options.raw)
+    # Each output's position in the processed files of a chunk: output, raw results, filter report
+    columns = [0, 1][:len(outfiles)]
+    if options.filter_report:
+        outfiles.append(options.filter_report)
+        columns.append(2)
+    
+    # Chunks are merged into the output in input order as they finish. A resumed
+    # run keeps the output up to the last chunk that was merged.
+    merged = [index for index in sorted(finished) if finished[index][3] is not None]
+    # Bounded producer/consumer: the reader blocks once QUEUE_DEPTH chunks per
+    # worker are in flight or waiting for an earlier chunk, and each merged chunk
+    # frees a slot for the next one. A slow chunk so holds back the reader instead
+    # of letting the reorder buffer and the temporary files grow.
+    slots = threading.BoundedSemaphore(num_cpus * QUEUE_DEPTH)
+    held = set()  # Chunks holding a slot
+    
+    def release_slot(index):
+        try:
+            held.remove(index)
+        except KeyError:  # Resumed, or already released
+            return
+        slots.release()
+    
+    merger = OrderedMerger(outfiles, finished[merged[-1]][3] if merged else [0] * len(outfiles), record_chunk, cache, reformat_result, metrics, columns, release_slot)
+    budget = MemoryBudget(parse_size(options.mem_budget), num_cpus) if options.mem_budget else None
+    errors = []
+    progress = 0
+    num_chunks = 0
+    num_reads_total = 0
+    num_classified = 0
+    filter_counts = {}  # Reads removed or trimmed, by filter
+    
+    def count_progress(num_seqs):
+        global progress
+        if not options.no_count:
+            progress += num_seqs
+            pbar.update(min(progress, total_lines))
+    
+    def chunk_done(index, num_seqs, order_file, hit_file, result, submitted=True):
+        try:
+            output_files, events = result
+            if budget and submitted:
+                budget.release(events)
+            for event in events:
+                for reason, count in event.get("filtered", {}).items():
+                    filter_counts[reason] = filter_counts.get(reason, 0) + count
+            metrics.add(events)
+            if options.pipe and order_file is not None:
+                # Later reads may repeat these sequences, and a resumed run reloads them
+                output_files = save_results(index, output_files)
+            if not options.pipe or order_file is not None:
+                record_chunk(index, "done", *(output_file or "-" for output_file in output_files))
+            merger.add(index, output_files, order_file, hit_file)
+            count_progress(num_seqs)
+        except Exception as error:
+            errors.append(error)
+            release_slot(index)
+    
+    def save_results(index, output_files):
+        saved = []
+        for number, data in enumerate(output_files):
+            saved.append(os.path.join(temp_dir, f"results_{index:05d}_{number}.txt") if data is not None else None)
+            if data is not None:
+                with open(saved[-1], "wb") as f:
+                    f.write(data)
+        return tuple(saved)
+    
+    def chunk_failed(index, error):
+        errors.append(error)
+        if budget:
+            budget.release()
+        release_slot(index)
+    
+    # With --persistent every pool worker owns one classifier for the whole run. Its
+    # JVM starts before anything is measured, so it gets an equal share of the budget.
+    initializer = start_classifier if options.persistent and options.engine == "rdp" else None
+    heap = f"{max(MIN_HEAP_MB, budget.budget // num_cpus // 2**20)}m" if budget else MAX_RAM
+    
+    # Recorded chunks are cut again at the same reads; finished ones are not sent again
+    planned = [finished[index][0] for index in sorted(finished)]
+    
+    # Pool workers take the next queued chunk as soon as they are free, and with -b the
+    # shrinking tail chunks leave no long chunk running alone at the end of the run
+    handle, raw = open_input(options.infile) if seq_index is None else (nullcontext(), seq_index)
+    target = ChunkTarget(chunk_size, chunk_bases, num_cpus, raw, seq_index.size if seq_index is not None else os.path.getsize(options.infile))
+    with handle, multiprocessing.Pool(processes=num_cpus, initializer=initializer, initargs=(options.rdp_db, heap)) as pool:
+        if seq_index is not None:
+            chunks = ((records, None, None) for records in read_ranges(seq_index, target, planned))
+        elif dereplicate:
+            chunks = read_unique_chunks(handle, target, cache, planned, fmt, read_filter)
+        else:
+            chunks = ((records, None, None) for records in read_chunks(handle, target, planned, fmt))
+        
+        for index, (records, order, hits) in enumerate(timed_chunks(chunks, metrics), 1):
+            if options.no_count:
+                pbar.update(min(raw.tell(), total_lines))
+            
+            num_chunks = index
+            num_reads = len(records) if order is None else len(order)
+            for read_id, digest, note in order or ():
+                if note:
+                    reason = note.split("\t", 1)[0]
+                    filter_counts[reason] = filter_counts.get(reason, 0) + 1
+            num_reads_total += num_reads
+            order_file = os.path.join(temp_dir, f"order_{index:05d}.txt") if order is not None else None
+            hit_file = os.path.join(temp_dir, f"cached_{index:05d}.txt") if hits else None
+            
+            if index in finished and finished[index][2]:
+                output_files = finished[index][1]
+                hit_file = os.path.join(temp_dir, f"cached_{index:05d}.txt")
+                hit_file = hit_file if os.path.exists(hit_file) else None
+                if finished[index][3] is not None:
+                    merger.skip(index, output_files, hit_file, dereplicate)
+                else:
+                    merger.add(index, output_files, order_file, hit_file)
+                count_progress(num_reads)
+                continue
+            
+            with metrics.stage("slot_wait", chunk=index):
+                slots.acquire()
+            held.add(index)
+            if errors:
+                break
+            
+            num_classified += len(records)
+            if index not in finished:
+                record_chunk(index, "queued", num_reads)
+            with metrics.stage("write_chunk", chunk=index):
+                if order is not None:
+                    with open(order_file, "w") as f:
+                        f.writelines(f"{read_id}\t{digest}\t{note}\n" if note else f"{read_id}\t{digest}\n" for read_id, digest, note in order)
+                    if hits:
+                        with open(hit_file, "w") as f:
+                            f.writelines(f"{digest}\t{result}" for digest, result in hits)
+                if isinstance(records, RecordRange):
+                    chunk = (records.start, records.end)  # The worker reads its own range
+                elif records and options.pipe:
+                    chunk = io.StringIO()
+                    SeqIO.write(records, chunk, "fasta")
+                    chunk = chunk.getvalue()
+                elif records:
+                    chunk = os.path.join(temp_dir, f"chunk_{index:05d}.fasta.gz")
+                    with gzip.open(chunk, "wt") as chunk_file:
+                        SeqIO.write(records, chunk_file, "fasta")
+            if not records:  # Only repeats or cached sequences
+                chunk_done(index, num_reads, order_file, hit_file, ((None, None, None), []), submitted=False)
+                continue
+            
+            if budget:
+                with metrics.stage("mem_wait", chunk=index) as fields:
+                    fields["workers"] = budget.acquire()
+                heap = budget.heap()
+            pool.apply_async(process_chunk, (chunk, f"cpu{index:05d}", temp_dir, index, time.time(), heap),
+                             callback=partial(chunk_done, index, num_reads, order_file, hit_file), error_callback=partial(chunk_failed, index))
         
-        with multiprocessing.Pool(processes=num_cpus) as pool:
-            for i in range(0, len(records), chunk_size * num_cpus):
-                chunk_tasks = []
-                for j in range(num_cpus):
-                    index = i + j * chunk_size
-                    if index >= len(records):
-                        break
-                    chunk_filename = os.path.join(temp_dir, f"chunk_{(index//chunk_size)+1:05d}.fasta.gz")
-                    with gzip.open(chunk_filename, "wt") as chunk_file:
-                        SeqIO.write(records[index:index + chunk_size], chunk_file, "fasta")
-                    
-                    chunk_tasks.append(pool.apply_async(
-                        process_chunk, (chunk_filename, f"cpu{(index//chunk_size)+1:05d}", temp_dir, chunk_size, progress_counter, lock)
-                    ))
-                
-                processed_files.extend([task.get() for task in chunk_tasks])
-    
-    with open(options.outfile, "w") as outfile:
-        subprocess.run(f"cat {' '.join(processed_files)} > {options.outfile}", shell=True, check=True)
-    
-    shutil.rmtree(temp_dir, ignore_errors=True)
+        pool.close()
+        pool.join()
+    
+    merger.close()
+    manifest.close()
+    if errors:
+        raise errors[0]
+    if merger.next_index != num_chunks + 1:
+        print(f"Chunks {merger.next_index} to {num_chunks} were not merged; rerun with --resume.")
+        exit(1)
+    
+    with metrics.stage("finish"):
+        if cache:
+            cache.evict()
+        shutil.rmtree(temp_dir, ignore_errors=True)
     pbar.finish()
+    if dereplicate:
+        print(f"Sequences classified: {num_classified} of {num_reads_total} reads")
+    if read_filter:
+        trimmed = filter_counts.pop("trimmed", 0)
+        print(f"Reads removed by the pre-filter: {sum(filter_counts.values())}"
+              + "".join(f", {reason} {count}" for reason, count in sorted(filter_counts.items())) + f"; trimmed: {trimmed}")
+    if metrics.enabled:
+        metrics.summary(run_start, num_reads_total, num_cpus)
+        metrics.close()
     print("All done.")
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+
+###################################################################
+# Naive Bayesian 8-mer classifier with bootstrap confidence
+# (Wang et al. 2007), the method used by the RDP Classifier,
+# implemented with NumPy so it can run inside opassign.
+#
+# Trains from the same reference FASTA as the RDP Classifier
+# (e.g. the -r output of grond2refdb.py, ">1<TAB>Root;Bacteria;...")
+# and writes the same layout as "classify", so its output can be
+# passed straight to reformatRDPTaxonomy.py.
+#
+# A trained model can be compiled to a flat file (-m). Compiled
+# models are memory-mapped read-only, so every process classifying
+# with the same file shares one copy of it in the page cache.
+#
+# Example:
+# ./rdpnb.py -r grond_refseq.fasta -i reads.fasta -o assigned_taxonomy_rdp_raw.txt
+# ./rdpnb.py -r grond_refseq.fasta -m grond.rdpnb
+# ./rdpnb.py -r grond.rdpnb -i reads.fasta -o assigned_taxonomy_rdp_raw.txt
+###################################################################
+
+import json
+import struct
+import zlib
+import numpy as np
+from Bio import SeqIO
+
+WORD_SIZE = 8
+NUM_WORDS = 4 ** WORD_SIZE
+NUM_BOOTSTRAPS = 100
+MIN_BOOTSTRAP_WORDS = 5
+
+# Same rank names as tax2rdp_utax.pl, by depth in the lineage
+RANKS = ["rootrank", "kingdom", "phylum", "class", "order", "family", "genus", "species", "sub1", "sub2", "sub3", "sub4"]
+
+# Query words scored together, and the upper bound on float32 cells of
+# log-probabilities gathered for them at once (64 MB)
+BATCH_WORDS = 1 << 16
+BATCH_CELLS = 1 << 24
+
+# A/C/G/T(U) -> 0..3, anything else -> 4 (word is skipped)
+ENCODE = np.full(256, 4, dtype=np.uint8)
+for i, bases in enumerate(["Aa", "Cc", "Gg", "TtUu"]):
+    for base in bases:
+        ENCODE[ord(base)] = i
+
+# Compiled model: magic, header length, JSON header, then the arrays
+# at MODEL_ALIGN-aligned offsets
+MODEL_MAGIC = b"RDPNBMDL"
+MODEL_ALIGN = 4096
+MODEL_ARRAYS = ["log_prob", "word_count", "lineage"]
+
+WORD_WEIGHTS = 4 ** np.arange(WORD_SIZE - 1, -1, -1, dtype=np.int64)
+
+class Model:
+    """Trained word-by-leaf log-probabilities plus the taxonomy they map to."""
+
+    def __init__(self, log_prob, word_count, lineage, names):
+        self.log_prob = log_prob        # (NUM_WORDS, leaves) float32, log P(word | leaf)
+        self.word_count = word_count    # (NUM_WORDS,) training sequences containing each word
+        self.lineage = lineage          # (leaves, depth) node ids from root down, -1 padded
+        self.names = names              # node id -> taxon name
+
+def encode(seq):
+    """Returns the base codes of a sequence string."""
+    return ENCODE[np.frombuffer(seq.encode(), dtype=np.uint8)]
+
+def words(codes):
+    """Returns the sorted, unique 8-mer indices of a coded sequence, skipping ambiguous words."""
+    if len(codes) < WORD_SIZE:
+        return np.empty(0, dtype=np.int64)
+    windows = np.lib.stride_tricks.sliding_window_view(codes, WORD_SIZE)
+    windows = windows[(windows < 4).all(axis=1)]
+    return np.unique(windows @ WORD_WEIGHTS)
+
+def reverse_complement(codes):
+    """Returns the reverse complement of a coded sequence, keeping ambiguous bases."""
+    return np.where(codes < 4, 3 - codes, codes)[::-1]
+
+def read_reference(fasta):
+    """Yields (lineage, sequence) from a training FASTA with the lineage after the ID."""
+    with open(fasta) as f:
+        for record in SeqIO.parse(f, "fasta"):
+            lineage = record.description.split(None, 1)[1].strip().split(";")
+            yield lineage, str(record.seq)
+
+def train(fasta):
+    """Trains a model from a reference FASTA."""
+    nodes = {}        # lineage prefix -> node id
+    leaves = {}       # full lineage -> leaf index
+    leaf_counts = []  # per leaf: sequences containing each word
+    leaf_sizes = []
+    word_count = np.zeros(NUM_WORDS, dtype=np.int64)
+
+    for lineage, seq in read_reference(fasta):
+        key = tuple(lineage)
+        for depth in range(len(key)):
+            nodes.setdefault(key[:depth + 1], len(nodes))
+        if key not in leaves:
+            leaves[key] = len(leaves)
+            leaf_counts.append(np.zeros(NUM_WORDS, dtype=np.int32))
+            leaf_sizes.append(0)
+        seq_words = words(encode(seq))
+        leaf_counts[leaves[key]][seq_words] += 1
+        leaf_sizes[leaves[key]] += 1
+        word_count[seq_words] += 1
+
+    # Word prior P(w) = (n(w) + 0.5) / (N + 1)
+    # Conditional P(w | leaf) = (m(w) + P(w)) / (M + 1)
+    word_prior = (word_count + 0.5) / (sum(leaf_sizes) + 1)
+    log_prob = np.empty((NUM_WORDS, len(leaves)), dtype=np.float32)
+    for leaf in range(len(leaves)):
+        log_prob[:, leaf] = np.log((leaf_counts[leaf] + word_prior) / (leaf_sizes[leaf] + 1))
+        leaf_counts[leaf] = None
+
+    max_depth = max(len(key) for key in leaves)
+    lineage = np.full((len(leaves), max_depth), -1, dtype=np.int32)
+    for key, leaf in leaves.items():
+        lineage[leaf, :len(key)] = [nodes[key[:depth + 1]] for depth in range(len(key))]
+
+    names = [None] * len(nodes)
+    for key, node in nodes.items():
+        names[node] = key[-1]
+
+    return Model(log_prob, word_count.astype(np.int32), lineage, names)
+
+def save(model, path):
+    """Writes a compiled model that load() can memory-map."""
+    header = {"names": model.names, "arrays": {}}
+    # Array offsets depend on the header length, so lay out until they settle
+    while True:
+        encoded = json.dumps(header).encode()
+        arrays = {}
+        offset = len(MODEL_MAGIC) + 8 + len(encoded)
+        for key in MODEL_ARRAYS:
+            array = getattr(model, key)
+            offset = -(-offset // MODEL_ALIGN) * MODEL_ALIGN
+            arrays[key] = {"offset": offset, "dtype": array.dtype.str, "shape": list(array.shape)}
+            offset += array.nbytes
+        if arrays == header["arrays"]:
+            break
+        header["arrays"] = arrays
+    with open(path, "wb") as f:
+        f.write(MODEL_MAGIC + struct.pack("<Q", len(encoded)) + encoded)
+        for key in MODEL_ARRAYS:
+            f.write(b"\0" * (arrays[key]["offset"] - f.tell()))
+            np.ascontiguousarray(getattr(model, key)).tofile(f)
+
+def is_compiled(path):
+    """Checks if a file is a compiled model."""
+    with open(path, "rb") as f:
+        return f.read(len(MODEL_MAGIC)) == MODEL_MAGIC
+
+def load(path):
+    """Memory-maps a compiled model read-only."""
+    with open(path, "rb") as f:
+        f.seek(len(MODEL_MAGIC))
+        header = json.loads(f.read(struct.unpack("<Q", f.read(8))[0]))
+    arrays = {key: np.memmap(path, dtype=spec["dtype"], mode="r", offset=spec["offset"], shape=tuple(spec["shape"]))
+              for key, spec in header["arrays"].items()}
+    return Model(arrays["log_prob"], arrays["word_count"], arrays["lineage"], header["names"])
+
+def load_model(path):
+    """Loads a compiled model, or trains one if given a reference FASTA."""
+    return load(path) if is_compiled(path) else train(path)
+
+def orient(model, seq):
+    """Returns the query words and whether the reverse complement matches the training data better."""
+    codes = encode(seq)
+    forward = words(codes)
+    reverse = words(reverse_complement(codes))
+    if np.count_nonzero(model.word_count[reverse]) > np.count_nonzero(model.word_count[forward]):
+        return reverse, True
+    return forward, False
+
+def bootstrap_counts(query_words, seq):
+    """Returns counts over the query's own words for the full query (row 0) and each bootstrap trial."""
+    num_words = len(query_words)
+    # Seeded from the sequence so a read gets the same result in any chunk or run
+    rng = np.random.default_rng(zlib.crc32(seq.encode()))
+    num_picks = max(num_words // WORD_SIZE, MIN_BOOTSTRAP_WORDS)
+    picks = rng.integers(0, num_words, size=(NUM_BOOTSTRAPS, num_picks))
+    picks += np.arange(NUM_BOOTSTRAPS)[:, None] * num_words
+    counts = np.empty((NUM_BOOTSTRAPS + 1, num_words), dtype=np.float32)
+    counts[0] = 1
+    counts[1:] = np.bincount(picks.ravel(), minlength=NUM_BOOTSTRAPS * num_words).reshape(NUM_BOOTSTRAPS, num_words)
+    return counts
+
+def best_leaves(model, batch_words, batch_counts):
+    """Returns the highest scoring leaf for every count row of a batch of reads."""
+    all_words = np.concatenate(batch_words)
+    offsets = np.cumsum([0] + [len(query_words) for query_words in batch_words])
+    num_rows = sum(len(counts) for counts in batch_counts)
+    num_leaves = model.log_prob.shape[1]
+
+    # Leaves are scored in blocks so the gathered log-probabilities stay under BATCH_CELLS
+    block = max(1, BATCH_CELLS // len(all_words))
+    best = np.zeros(num_rows, dtype=np.int64)
+    best_score = np.full(num_rows, -np.inf, dtype=np.float32)
+    for start in range(0, num_leaves, block):
+        log_prob = model.log_prob[all_words, start:start + block]
+        scores = np.concatenate([counts @ log_prob[offsets[i]:offsets[i + 1]] for i, counts in enumerate(batch_counts)])
+        block_best = scores.argmax(axis=1)
+        block_score = scores[np.arange(num_rows), block_best]
+        better = block_score > best_score
+        best[better] = block_best[better] + start
+        best_score[better] = block_score[better]
+    return best
+
+def format_result(model, name, reverse, leaf, confidence):
+    """Formats one classification like the RDP Classifier (allrank)."""
+    line = name + "\t" + ("-" if reverse else "")
+    for depth, node in enumerate(model.lineage[leaf]):
+        if node < 0:
+            break
+        line += f"\t{model.names[node]}\t{RANKS[depth]}\t{round(float(confidence[depth]), 2)}"
+    return line + "\n"
+
+def classify(model, records):
+    """Classifies (name, sequence) pairs and returns one output line per record, in order."""
+    queries = [(name, seq) + orient(model, seq) for name, seq in records]
+    lines = [None] * len(queries)
+
+    # Reads with no usable words (too short or all ambiguous) are left as Root only
+    scored = [i for i, query in enumerate(queries) if len(query[2])]
+    for i, query in enumerate(queries):
+        if not len(query[2]):
+            lines[i] = query[0] + "\t\tRoot\trootrank\t1.0\n"
+
+    start = 0
+    while start < len(scored):
+        # Batch reads up to BATCH_WORDS query words in total
+        end = start + 1
+        total_words = len(queries[scored[start]][2])
+        while end < len(scored) and total_words + len(queries[scored[end]][2]) <= BATCH_WORDS:
+            total_words += len(queries[scored[end]][2])
+            end += 1
+        batch = scored[start:end]
+
+        batch_words = [queries[i][2] for i in batch]
+        batch_counts = [bootstrap_counts(queries[i][2], queries[i][1]) for i in batch]
+        best = best_leaves(model, batch_words, batch_counts).reshape(len(batch), NUM_BOOTSTRAPS + 1)
+
+        # Confidence at each rank: fraction of trials that agree with the
+        # full-sequence assignment down to that rank
+        assigned = model.lineage[best[:, 0]]
+        trials = model.lineage[best[:, 1:]]
+        confidence = (trials == assigned[:, None, :]).mean(axis=1)
+
+        for j, i in enumerate(batch):
+            lines[i] = format_result(model, queries[i][0], queries[i][3], best[j, 0], confidence[j])
+
+        start = end
+
+    return lines
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser("Naive Bayesian k-mer classifier (RDP Classifier method) in NumPy.")
+    parser.add_argument("-r", required=True, dest="reference", metavar="reference", help="[REQUIRED] Reference training FASTA or compiled model")
+    parser.add_argument("-i", dest="infile", metavar="infile", help="[OPTIONAL] Sequences to classify")
+    parser.add_argument("-o", dest="outfile", metavar="outfile", help="[OPTIONAL] Classification output")
+    parser.add_argument("-m", dest="model", metavar="model", help="[OPTIONAL] Write the compiled model to this file")
+    options = parser.parse_args()
+
+    if bool(options.infile) != bool(options.outfile) or not (options.infile or options.model):
+        parser.error("either -m, or both -i and -o, are required")
+
+    model = load_model(options.reference)
+    if options.model:
+        save(model, options.model)
+    if not options.infile:
+        exit(0)
+
+    with open(options.infile) as f, open(options.outfile, "w") as out:
+        records = []
+        for record in SeqIO.parse(f, "fasta"):
+            records.append((record.id, str(record.seq)))
+            if len(records) == 1000:
+                out.writelines(classify(model, records))
+                records = []
+        out.writelines(classify(model, records))
@@ -0,0 +1,88 @@
+import edu.msu.cme.rdp.classifier.ClassificationResult;
+import edu.msu.cme.rdp.classifier.Classifier;
+import edu.msu.cme.rdp.classifier.RankAssignment;
+import edu.msu.cme.rdp.classifier.utils.ClassifierFactory;
+import edu.msu.cme.rdp.classifier.utils.ClassifierSequence;
+import edu.msu.cme.rdp.readseq.readers.Sequence;
+
+import java.io.BufferedReader;
+import java.io.InputStreamReader;
+import java.io.PrintStream;
+
+///////////////////////////////////////////////////////////////////
+// Long-lived RDP Classifier worker used by opassign --persistent.
+//
+// Loads the trained model once, then reads FASTA batches from stdin.
+// Each batch is terminated by a line containing only "//". The
+// classifications for a batch are written to stdout in the same
+// layout as "classify" (allrank), followed by a "//" line. The
+// worker exits when stdin is closed.
+//
+// Build:
+// javac -cp /path/to/classifier.jar RDPWorker.java
+///////////////////////////////////////////////////////////////////
+
+public class RDPWorker {
+
+    private static Classifier classifier;
+    private static StringBuilder batch = new StringBuilder();
+
+    public static void main(String[] args) throws Exception {
+
+        ClassifierFactory.setDataProp(args[0], false);
+        classifier = ClassifierFactory.getFactory().createClassifier();
+
+        BufferedReader in = new BufferedReader(new InputStreamReader(System.in), 1 << 20);
+        PrintStream out = new PrintStream(System.out, false);
+
+        String name = null;
+        StringBuilder seq = new StringBuilder();
+        String line;
+
+        while ((line = in.readLine()) != null) {
+
+            if (line.startsWith(">")) {
+                if (name != null) {
+                    classify(name, seq.toString());
+                }
+                name = line.substring(1).trim().split("\\s+")[0];
+                seq.setLength(0);
+            } else if (line.equals("//")) {
+                if (name != null) {
+                    classify(name, seq.toString());
+                }
+                name = null;
+                seq.setLength(0);
+
+                // Results are held back until the whole batch has been read
+                // so the caller can write a batch without reading concurrently
+                out.print(batch);
+                out.print("//\n");
+                out.flush();
+                batch.setLength(0);
+            } else {
+                seq.append(line.trim());
+            }
+        }
+    }
+
+    private static void classify(String name, String seq) {
+        try {
+            ClassificationResult result = classifier.classify(new ClassifierSequence(new Sequence(name, "", seq)));
+            batch.append(name).append('\t');
+            if (result.getSequence().isReverse()) {
+                batch.append('-');
+            }
+            for (Object o : result.getAssignments()) {
+                RankAssignment assignment = (RankAssignment) o;
+                batch.append('\t').append(assignment.getName());
+                batch.append('\t').append(assignment.getRank());
+                batch.append('\t').append(assignment.getConfidence());
+            }
+            batch.append('\n');
+        } catch (Exception e) {
+            // Same behaviour as "classify": report and skip the sequence
+            System.err.println("Failed to classify " + name + ": " + e.getMessage());
+        }
+    }
+}
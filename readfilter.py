@@ -0,0 +1,95 @@
+###################################################################
+# Pre-filter for reads ahead of classification: drops reads that
+# are too short or too long, mostly N, or of low complexity (long
+# homopolymers, low trinucleotide entropy), and can trim over-long
+# reads to a length cap instead.
+#
+# opassign2.py runs it in each worker on the chunk's FASTA text
+# just before the classifier. Every removed or trimmed read gets
+# a report line: its ID, the filter and its original length.
+###################################################################
+
+import math
+import re
+import numpy as np
+
+# Code of each base in a trinucleotide; any other byte (N, IUPAC codes) is 4 and
+# leaves the trinucleotides containing it uncounted
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for code, bases in enumerate((b"Aa", b"Cc", b"Gg", b"Tt")):
+    BASE_CODES[list(bases)] = code
+
+def trinucleotide_entropy(seq):
+    """Shannon entropy of the trinucleotides of a sequence, scaled to 0-1.
+
+    1 means all 64 trinucleotides (or as many as the read has) are equally frequent;
+    a homopolymer or a short repeated motif scores close to 0."""
+    codes = BASE_CODES[np.frombuffer(seq.encode(), dtype=np.uint8)]
+    if len(codes) < 3:
+        return 0.0
+    first, second, third = codes[:-2], codes[1:-1], codes[2:]
+    valid = (first < 4) & (second < 4) & (third < 4)
+    words = (first[valid].astype(np.int32) * 16) + (second[valid] * 4) + third[valid]
+    total = len(words)
+    if total < 2:
+        return 0.0
+    p = np.bincount(words, minlength=64)
+    p = p[p > 0] / total
+    return float(-(p * np.log2(p)).sum() / math.log2(min(64, total)))
+
+class ReadFilter:
+    """Length, N-fraction and complexity filters, and an optional length cap, for FASTA reads."""
+
+    def __init__(self, min_length=None, max_length=None, max_n_fraction=None, max_homopolymer=None, min_entropy=None, trim_length=None):
+        self.min_length = min_length
+        self.max_length = max_length
+        self.max_n_fraction = max_n_fraction
+        self.max_homopolymer = max_homopolymer
+        self.min_entropy = min_entropy
+        self.trim_length = trim_length
+        self.homopolymer = None
+        if max_homopolymer is not None:
+            self.homopolymer = re.compile("|".join(f"{base}{{{max_homopolymer + 1}}}" for base in "ACGT"), re.IGNORECASE)
+
+    def settings(self):
+        return {name: value for name, value in vars(self).items() if name != "homopolymer" and value is not None}
+
+    def __bool__(self):
+        return bool(self.settings())
+
+    def __str__(self):
+        """The settings, e.g. min_length=1000,trim_length=6000; identifies the filter in run headers."""
+        return ",".join(f"{name}={value}" for name, value in self.settings().items())
+
+    def reason(self, seq):
+        """The filter that removes a read, or None if it is kept."""
+        if self.min_length is not None and len(seq) < self.min_length:
+            return "min_length"
+        if self.max_length is not None and len(seq) > self.max_length:
+            return "max_length"
+        if self.max_n_fraction is not None and seq.upper().count("N") > self.max_n_fraction * len(seq):
+            return "n_fraction"
+        if self.homopolymer is not None and self.homopolymer.search(seq):
+            return "homopolymer"
+        if self.min_entropy is not None and trinucleotide_entropy(seq) < self.min_entropy:
+            return "entropy"
+        return None
+
+    def filter_fasta(self, text):
+        """Filters FASTA text. Returns the kept reads, trimmed to the cap, as FASTA text with
+        one line per sequence, and (read ID, filter, length) of every read removed or trimmed."""
+        kept = []
+        report = []
+        for record in ("\n" + text).split("\n>")[1:]:
+            header, _, seq = record.partition("\n")
+            seq = seq.replace("\n", "")
+            read_id = (header.split(None, 1) or [""])[0]
+            reason = self.reason(seq)
+            if reason is not None:
+                report.append((read_id, reason, len(seq)))
+                continue
+            if self.trim_length is not None and len(seq) > self.trim_length:
+                report.append((read_id, "trimmed", len(seq)))
+                seq = seq[:self.trim_length]
+            kept.append(f">{header}\n{seq}\n")
+        return "".join(kept), report
@@ -1,115 +1,125 @@
 #!/usr/bin/python
 
-############################################################
-# Argument Options
-
-import argparse
-parser = argparse.ArgumentParser("Re-format taxonomy assignment output from RDP-CLASSIFIER.")
-parser.add_argument("-i, --in",
-                    action = "store",
-                    dest = "input",
-                    metavar = "input",
-                    help = "[REQUIRED] taxonomy assignment output from RDP-CLASSIFIER",
-                    required = True)
-parser.add_argument("-o, --out",
-                    action = "store",
-                    dest = "output",
-                    metavar = "output",
-                    help = "[REQUIRED] reformatted taxonomy assignment file",
-                    required = True)
-parser.add_argument("-c",
-                    action = "store",
-                    dest = "confidence",
-                    metavar = "confidence",
-                    help = "[REQUIRED] Minimum confidence to record an assignment",
-                    required = True)
-options = parser.parse_args()
-
-############################################################
-
-import sys
-
-THRESHOLD = float(options.confidence)
-
-handle_input = open(options.input, "r")
-handle_output = open(options.output, "w")
-
-
-for line in handle_input:
-
+import gzip
+from functools import partial
+
+# Bytes of input lines read at a time; each block is parsed once for all thresholds,
+# and kept small so the parsed lines never pile up in memory
+BLOCK_SIZE = 256 * 1024
+
+# Prefix written before the name of each rank in the RDP Classifier output
+RANK_PREFIXES = {
+    "domain": "k__",
+    "kingdom": "k__",
+    "phylum": "p__",
+    "subphylum": "subp__",
+    "class": "c__",
+    "subclass": "subc__",
+    "order": "o__",
+    "family": "f__",
+    "genus": "g__",
+    "species": "s__",
+}
+
+def parse_rank_prefixes(text):
+    """Returns RANK_PREFIXES with comma-separated rank=prefix pairs added or replaced."""
+    prefixes = dict(RANK_PREFIXES)
+    for pair in filter(None, (text or "").split(",")):
+        rank, _, prefix = pair.partition("=")
+        prefixes[rank.strip()] = prefix.strip()
+    return prefixes
+
+def parse(line, prefixes=RANK_PREFIXES):
+    """Splits one line of RDP Classifier output into its ID and the prefixed names and confidences of its ranks."""
     e = line.rstrip().split("\t")
-    taxonomy = []
-    taxonomy_conf = []
-
+    names = []
+    confidences = []
     for i in range(5, len(e), 3):
-
-        tax_level = e[i+1]
-        tax_nomenclature = e[i].split("|")[-1].replace(" ", "_")
-        tax_confidence = float(e[i+2])
-
-        if tax_level == "domain" or tax_level == "kingdom":
-            tax_nomenclature = "k__" + tax_nomenclature
-        elif tax_level == "phylum":
-            tax_nomenclature = "p__" + tax_nomenclature
-        elif tax_level == "subphylum":
-            tax_nomenclature = "subp__" + tax_nomenclature
-        elif tax_level == "class":
-            tax_nomenclature = "c__" + tax_nomenclature
-        elif tax_level == "subclass":
-            tax_nomenclature = "subc__" + tax_nomenclature
-        elif tax_level == "order":
-            tax_nomenclature = "o__" + tax_nomenclature
-        elif tax_level == "family":
-            tax_nomenclature = "f__" + tax_nomenclature
-        elif tax_level == "genus":
-            tax_nomenclature = "g__" + tax_nomenclature
-        elif tax_level == "species":
-            tax_nomenclature = "s__" + tax_nomenclature
-        else:
-            print(tax_level, "Error in RDP Classifier produced output: not a valid taxonomic level.")
-            exit(1)
-
-        taxonomy.append(tax_nomenclature)
-        taxonomy_conf.append(tax_confidence)
-
-    '''
-    Kingdom = "k__" + e[5]
-    Kingdom_conf = float(e[7])
-    Phylum = "p__" + e[8].split("|")[-1]
-    Phylum_conf = float(e[10])
-    Class = "c__" + e[11].split("|")[-1]
-    Class_conf = float(e[13])
-    Order = "o__" + e[14].split("|")[-1]
-    Order_conf = float(e[16])
-    Family = "f__" + e[17].split("|")[-1]
-    Family_conf = float(e[19])
-    Genus = "g__" + e[20].split("|")[-1]
-    Genus_conf = float(e[22])
-    Species = "s__" + e[23].split("|")[-1]
-    Species_conf = float(e[25])
-    '''
-
-    taxonomy_filtered = []
-    taxonomy_conf_filtered = []
-
-    for i in range(len(taxonomy)):
-        if taxonomy_conf[i] >= THRESHOLD:
-            taxonomy_filtered.append(taxonomy[i])
-            taxonomy_conf_filtered.append(taxonomy_conf[i])
-        else:
+        prefix = prefixes.get(e[i+1])
+        if prefix is None:
+            raise ValueError(f"{e[i+1]} Error in RDP Classifier produced output: not a valid taxonomic level.")
+        names.append(prefix + e[i].split("|")[-1].replace(" ", "_"))
+        confidences.append(float(e[i+2]))
+    return e[0], names, confidences
+
+def filter_taxonomy(read_id, names, confidences, threshold):
+    """Formats the ranks down to the first one below the threshold, and the confidence of the last rank kept."""
+    depth = 0
+    for confidence in confidences:
+        if confidence < threshold:
             break
-
-    if len(taxonomy_conf_filtered) == 0:
-        taxonomy_filtered.append("Unassignable")
-        taxonomy_conf_filtered.append(1.0)
-
-    # print(";".join(taxonomy_filtered))
-    # print(";".join(map(str, taxonomy_conf_filtered)))
-
-    handle_output.write(e[0] + "\t")
-    handle_output.write("; ".join(taxonomy_filtered) + "\t")
-    handle_output.write(str(taxonomy_conf_filtered[-1]) + "\n")
-
-
-handle_input.close()
-handle_output.close()
+        depth += 1
+    if depth == 0:
+        return read_id + "\tUnassignable\t1.0\n"
+    return f"{read_id}\t{'; '.join(names[:depth])}\t{confidences[depth - 1]}\n"
+
+def reformat(line, threshold, prefixes=RANK_PREFIXES):
+    """Reformats one line of RDP Classifier output at one confidence threshold."""
+    return filter_taxonomy(*parse(line, prefixes), threshold)
+
+def open_input(filename):
+    """Opens a plain or gzipped file for reading."""
+    with open(filename, "rb") as f:
+        gzipped = f.read(2) == b"\x1f\x8b"  # Gzip magic number
+    return gzip.open(filename, "rt") if gzipped else open(filename, "r")
+
+def open_output(filename):
+    """Opens an output file, gzipped if its name ends in .gz."""
+    return gzip.open(filename, "wt") if filename.endswith(".gz") else open(filename, "w")
+
+if __name__ == "__main__":
+
+    ############################################################
+    # Argument Options
+
+    import argparse
+    parser = argparse.ArgumentParser("Re-format taxonomy assignment output from RDP-CLASSIFIER.")
+    parser.add_argument("-i, --in",
+                        action = "store",
+                        dest = "input",
+                        metavar = "input",
+                        help = "[REQUIRED] taxonomy assignment output from RDP-CLASSIFIER (plain or gzipped)",
+                        required = True)
+    parser.add_argument("-o, --out",
+                        action = "store",
+                        dest = "output",
+                        metavar = "output",
+                        help = "[REQUIRED] reformatted taxonomy assignment file, or comma-separated files, one per -c threshold (gzipped if ending in .gz)",
+                        required = True)
+    parser.add_argument("-c",
+                        action = "store",
+                        dest = "confidence",
+                        metavar = "confidence",
+                        help = "[REQUIRED] Minimum confidence to record an assignment, or comma-separated thresholds written in a single pass",
+                        required = True)
+    parser.add_argument("--rank-prefixes",
+                        action = "store",
+                        dest = "rank_prefixes",
+                        metavar = "rank_prefixes",
+                        help = "[OPTIONAL] Comma-separated rank=prefix pairs added to or replacing the defaults, e.g. strain=t__")
+    options = parser.parse_args()
+
+    ############################################################
+
+    thresholds = [float(confidence) for confidence in options.confidence.split(",")]
+    outputs = options.output.split(",")
+    if len(outputs) != len(thresholds):
+        parser.error("-o needs one output file per -c threshold")
+    prefixes = parse_rank_prefixes(options.rank_prefixes)
+
+    handle_input = open_input(options.input)
+    handles_output = [open_output(output) for output in outputs]
+
+    # Every line is split and parsed once, then filtered at each threshold
+    try:
+        for lines in iter(partial(handle_input.readlines, BLOCK_SIZE), []):
+            parsed = [parse(line, prefixes) for line in lines]
+            for threshold, handle_output in zip(thresholds, handles_output):
+                handle_output.writelines(filter_taxonomy(*line, threshold) for line in parsed)
+    except ValueError as error:
+        print(error)
+        exit(1)
+
+    handle_input.close()
+    for handle_output in handles_output:
+        handle_output.close()
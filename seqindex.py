@@ -0,0 +1,232 @@
+###################################################################
+# Byte-offset index of the records in a plain FASTA or FASTQ file,
+# like a samtools faidx index, built with one regular expression
+# pass over the memory-mapped file.
+#
+# BGZF files (bgzip, as written by samtools and htslib) are indexed
+# the same way in uncompressed offsets: their blocks are found from
+# the block headers alone, and worker processes decompress and scan
+# groups of blocks in parallel.
+#
+# opassign2.py hands chunks to its workers as byte ranges of the
+# input. Each worker reads its own range through the same mapping,
+# or decompresses just the blocks that hold it, so the parent never
+# parses or copies the sequences.
+###################################################################
+
+import bisect
+import mmap
+import re
+import struct
+import zlib
+from array import array
+
+# A FASTA record is its header line, its first sequence line and any
+# further lines, up to the next '>'
+FASTA_RECORD = re.compile(rb">[^\n]*\n([^>\n]*)\n?([^>]*)")
+# Four-line FASTQ records, as basecallers write them
+FASTQ_RECORD = re.compile(rb"@([^\n]*)\n([^\n]*)\n\+[^\n]*\n[^\n]*(?:\n|$)")
+# The first record start after a newline; a FASTQ quality line may also
+# start with '@', but is never followed by a line and then a '+' line
+RECORD_START = {"fasta": re.compile(rb"\n(>)"), "fastq": re.compile(rb"\n(@[^\n]*\n[^\n]*\n\+)")}
+
+# gzip header of a BGZF block: FEXTRA set, and a 'BC' subfield giving the block size
+BGZF_MAGIC = b"\x1f\x8b\x08\x04"
+# Blocks (of at most 64 kB uncompressed) decompressed and scanned by one task while indexing
+INDEX_SPAN_BLOCKS = 256
+
+# BgzfIndex being indexed, handed to each indexing worker once by share_index, so
+# tasks carry only their span and not the block table or the records found so far
+scan_index = None
+
+def file_format(first_byte):
+    """fastq if a file starts with a FASTQ header, otherwise fasta."""
+    return "fastq" if first_byte == b"@" else "fasta"
+
+def is_bgzf(filename):
+    with open(filename, "rb") as f:
+        header = f.read(16)
+    return header[:4] == BGZF_MAGIC and header[12:14] == b"BC"
+
+def scan_records(fmt, data, start=0, end=None):
+    """Start offsets and numbers of bases of the records that start in data[start:end]."""
+    offsets = array("q")
+    bases = array("q")
+    end = len(data) if end is None else end
+    if fmt == "fastq":
+        for match in FASTQ_RECORD.finditer(data, start):
+            if match.start() >= end:
+                break
+            offsets.append(match.start())
+            bases.append(match.end(2) - match.start(2))
+    else:
+        for match in FASTA_RECORD.finditer(data, start):
+            if match.start() >= end:
+                break
+            offsets.append(match.start())
+            num_bases = match.end(1) - match.start(1)
+            if match.end(2) > match.start(2):  # Wrapped sequence lines
+                rest = data[match.start(2):match.end(2)]
+                num_bases += len(rest) - rest.count(b"\n")
+            bases.append(num_bases)
+    return offsets, bases
+
+class RecordRange:
+    """Consecutive records of an indexed file: their bytes start:end and their number of bases."""
+
+    __slots__ = ("start", "end", "reads", "bases")
+
+    def __init__(self, start, end, reads, bases):
+        self.start = start
+        self.end = end
+        self.reads = reads
+        self.bases = bases
+
+    def __len__(self):
+        return self.reads
+
+class SeqIndex:
+    """Start offset and number of bases of every record of a plain FASTA or FASTQ file."""
+
+    def __init__(self, filename):
+        self.file = open(filename, "rb")
+        self.size = self.file.seek(0, 2)
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b""
+        self.format = file_format(self.map[:1])
+        self.position = 0  # End of the last range handed out
+        # Start of every record, then the end of the file
+        self.offsets, self.bases = scan_records(self.format, self.map)
+        self.offsets.append(self.size)
+
+    def __len__(self):
+        return len(self.bases)
+
+    def tell(self):
+        """Bytes of the file up to the last range handed out, as a file's tell() would report."""
+        return self.position
+
+    def range(self, first, last):
+        """Records first to last (exclusive) as a RecordRange."""
+        self.position = self.offsets[last]
+        return RecordRange(self.offsets[first], self.offsets[last], last - first, sum(self.bases[first:last]))
+
+    def read(self, start, end):
+        return self.map[start:end]
+
+    def fasta(self, start, end):
+        """The records in bytes start:end of the file as FASTA text."""
+        data = self.read(start, end)
+        if self.format == "fastq":
+            data = FASTQ_RECORD.sub(rb">\1\n\2\n", data)
+        return data.decode()
+
+class BgzfIndex(SeqIndex):
+    """SeqIndex of a BGZF file, in uncompressed offsets.
+
+    The block table comes from the block headers and trailers without decompressing
+    anything; index_records then scans groups of blocks in parallel, in processes
+    started with share_index as their initializer."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.position = 0
+        # Compressed and uncompressed start of every block, then the end of the file
+        self.block_offsets = array("q", [0])
+        self.data_offsets = array("q", [0])
+        with open(filename, "rb") as f:
+            while True:
+                header = f.read(18)
+                if len(header) < 18:
+                    break
+                if header[:4] != BGZF_MAGIC or header[12:14] != b"BC":
+                    raise ValueError(f"{filename}: not a BGZF block at byte {self.block_offsets[-1]}")
+                block_size = struct.unpack("<H", header[16:18])[0] + 1
+                f.seek(self.block_offsets[-1] + block_size - 4)
+                self.block_offsets.append(self.block_offsets[-1] + block_size)
+                self.data_offsets.append(self.data_offsets[-1] + struct.unpack("<I", f.read(4))[0])
+        self.size = self.data_offsets[-1]
+        self.format = file_format(self.read(0, 1))
+        self.offsets = array("q")
+        self.bases = array("q")
+
+    def read(self, start, end):
+        """Bytes start:end of the uncompressed file, decompressing only the blocks that hold them."""
+        end = min(end, self.size)
+        if start >= end:
+            return b""
+        first = bisect.bisect_right(self.data_offsets, start) - 1
+        last = bisect.bisect_left(self.data_offsets, end)
+        with open(self.filename, "rb") as f:
+            f.seek(self.block_offsets[first])
+            blocks = f.read(self.block_offsets[last] - self.block_offsets[first])
+        data = []
+        for block_start, block_end in zip(self.block_offsets[first:last], self.block_offsets[first + 1:last + 1]):
+            block = blocks[block_start - self.block_offsets[first]:block_end - self.block_offsets[first]]
+            extra = struct.unpack("<H", block[10:12])[0]
+            data.append(zlib.decompress(block[12 + extra:-8], -15))  # Raw deflate between header and trailer
+        data = b"".join(data)
+        offset = self.data_offsets[first]
+        return data[start - offset:end - offset]
+
+    def scan_span(self, span):
+        """Offsets and bases of the records starting in uncompressed bytes span[0]:span[1]."""
+        start, end = span
+        # One byte before the span shows whether it starts at a line start, and the data
+        # runs on to the next record start after the span so its last record is whole
+        from_byte = max(0, start - 1)
+        data = self.read(from_byte, end)
+        pattern = RECORD_START[self.format]
+        while from_byte + len(data) < self.size and not pattern.search(data, end - from_byte - 1):
+            data += self.read(from_byte + len(data), from_byte + len(data) + (end - start))
+        if start == 0:
+            first = 0
+        else:
+            match = pattern.search(data)
+            if match is None or match.start(1) >= end - from_byte:
+                return array("q"), array("q")
+            first = match.start(1)
+        offsets, bases = scan_records(self.format, data, first, end - from_byte)
+        return array("q", (offset + from_byte for offset in offsets)), bases
+
+    def index_records(self, map_function=map):
+        """Indexes the records, with map_function (such as the imap of a pool started with
+        initializer=share_index, initargs=(self,)) scanning groups of blocks."""
+        share_index(self)
+        bounds = self.data_offsets[::INDEX_SPAN_BLOCKS]
+        if bounds[-1] != self.size:
+            bounds.append(self.size)
+        for offsets, bases in map_function(scan_span, zip(bounds, bounds[1:])):
+            self.offsets.extend(offsets)
+            self.bases.extend(bases)
+        self.offsets.append(self.size)
+
+def share_index(index):
+    """Pool initializer: the BgzfIndex that scan_span tasks read from."""
+    global scan_index
+    scan_index = index
+
+def scan_span(span):
+    return scan_index.scan_span(span)
+
+def read_ranges(index, target, planned=()):
+    """Cuts the indexed records into RecordRanges where target says a chunk is full.
+
+    The first chunks take their sizes from planned, so a resumed run cuts the same chunks."""
+    sizes = iter(planned)
+    first = 0
+    while first < len(index):
+        planned_reads = next(sizes, None)
+        last = first
+        num_bases = 0
+        while last < len(index):
+            num_bases += index.bases[last]
+            last += 1
+            if planned_reads is not None:
+                full = last - first >= planned_reads
+            else:
+                full = target.full(last - first, num_bases)
+            if full:
+                break
+        yield index.range(first, last)
+        target.next_chunk(num_bases)
+        first = last
@@ -0,0 +1,19 @@
+import os
+import subprocess
+import sys
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "uc2otutable.py")
+
+def uc_line(record, query, target="*"):
+    return "\t".join([record, "0", "100", "*", "*", "*", "*", "*", query, target]) + "\n"
+
+def test_repeated_seed_resets_counts(tmp_path):
+    # A repeated S record drops the hits counted for its OTU so far, as the original script did
+    uc = tmp_path / "clusters.uc"
+    uc.write_text(uc_line("S", "A_1") + uc_line("H", "B_1", "A_1") + uc_line("H", "B_2", "A_1")
+                  + uc_line("S", "A_1") + uc_line("H", "B_3", "A_1") + uc_line("S", "C_1"))
+    samples = tmp_path / "samples.txt"
+    samples.write_text("#SampleID\nA\nB\nC\n")
+    table = tmp_path / "otutable.txt"
+    subprocess.run([sys.executable, SCRIPT, "-i", str(uc), "-o", str(table), "-l", str(samples)], check=True, capture_output=True)
+    assert table.read_text() == "#OTU_ID\tA\tB\tC\nA_1\t1\t1\t0\nC_1\t0\t0\t1\n"
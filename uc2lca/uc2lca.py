@@ -1,5 +1,9 @@
 #!/usr/bin/env python
 
+import contextlib
+import multiprocessing
+import os
+import sqlite3
 import sys
 
 ###################################################################
@@ -10,6 +14,7 @@ import sys
 # 
 # Example:
 # ./uc2lca.py --uc example.uc --tax example.tsv -o lca.tsv
+# ./uc2lca.py --uc example.uc --tax example.tsv --index example.idx -o lca.tsv
 ###################################################################
 
 import argparse
@@ -26,6 +31,18 @@ parser.add_argument("--tax",
                     metavar = "tax",
                     help = "[REQUIRED]",
                     required = True)
+parser.add_argument("--index",
+                    action = "store",
+                    dest = "index",
+                    metavar = "index",
+                    help = "[OPTIONAL] SQLite index of --tax, built on first use and rebuilt when --tax changes; "
+                           "runs with it look up only the IDs in the .uc file")
+parser.add_argument("-t",
+                    action = "store",
+                    dest = "threads",
+                    metavar = "threads",
+                    help = "[OPTIONAL] Number of processes reading the .uc file",
+                    default = "1")
 parser.add_argument("-o",
                     action = "store",
                     dest = "outfile",
@@ -36,15 +53,73 @@ options = parser.parse_args()
 
 ############################################################
 
-def read_uc():
-    repseq = {}
-    with open(options.uc, "r") as f:
+# Byte ranges of the .uc file per process with -t, so uneven ranges even out
+SHARDS_PER_THREAD = 4
 
-        line_count = 0
+class Lineages:
+    """Interns lineages as nodes of a prefix tree: a lineage is one integer, and the
+    common prefix of two lineages is their lowest common node."""
 
-        for line in f:
+    def __init__(self):
+        self.children = {}  # (parent node, name) -> node
+        self.parent = [0]   # Node 0 is the empty lineage
+        self.name = [None]
+        self.depth = [0]
+
+    def intern(self, names):
+        node = 0
+        for name in names:
+            child = self.children.get((node, name))
+            if child is None:
+                child = self.children[(node, name)] = len(self.parent)
+                self.parent.append(node)
+                self.name.append(name)
+                self.depth.append(self.depth[node] + 1)
+            node = child
+        return node
+
+    def common(self, a, b):
+        parent, depth = self.parent, self.depth
+        while depth[a] > depth[b]:
+            a = parent[a]
+        while depth[b] > depth[a]:
+            b = parent[b]
+        while a != b:
+            a = parent[a]
+            b = parent[b]
+        return a
+
+    def names(self, node):
+        names = []
+        while node:
+            names.append(self.name[node])
+            node = self.parent[node]
+        return names[::-1]
+
+def read_uc_shard(start, end):
+    # Clusters of the lines starting in [start, end), in order of first appearance:
+    # [common lineage node, longest member lineage length, has an S record].
+    # A cluster with an S record starts again from the last one, as in a serial read.
+    clusters = {}
+    # S records of clusters seen before: (ID, True) if seen in this shard, else
+    # (ID, False) to be checked against the earlier shards
+    warnings = []
+    line_count = 0
+    with open(options.uc, "rb") as f:
+
+        # A shard starts at the first line starting at or after its first byte
+        if start:
+            f.seek(start - 1)
+            start += len(f.readline()) - 1
+        position = start
+
+        while position < end:
 
-            line = line.rstrip()
+            line = f.readline()
+            if not line:
+                break
+            position += len(line)
+            line = line.decode().rstrip()
             line_count += 1
 
             if not line or line.startswith("#"):
@@ -52,9 +127,7 @@ def read_uc():
             fields = line.split("\t")
 
             if len(fields) < 10:
-
-                print(f"line {line_count} in .uc file has < 10 fields", file = sys.stderr)
-                sys.exit(1)
+                return clusters, warnings, line_count, line_count
 
             record_type = fields[0]
             query_id = fields[8]
@@ -62,54 +135,159 @@ def read_uc():
 
             if record_type == "S":
 
-                if query_id in repseq:
-                    print(f"something wrong: {query_id}")
+                warnings.append((query_id, query_id in clusters))
 
-                repseq[query_id] = [tax[query_id]]
+                node = tax[query_id]
+                clusters[query_id] = [node, lineages.depth[node], True]
 
             elif record_type == "H":
 
-                # print(query_id)
-                repseq.setdefault(target_id, []).append(tax[query_id])
+                node = tax[query_id]
+                cluster = clusters.get(target_id)
+                if cluster is None:
+                    clusters[target_id] = [node, lineages.depth[node], False]
+                else:
+                    narrow(cluster, node, lineages.depth[node])
+
+    return clusters, warnings, line_count, None
+
+def read_uc_shard_range(shard):
+    return read_uc_shard(*shard)
+
+def narrow(cluster, node, length):
+    cluster[0] = lineages.common(cluster[0], node)
+    cluster[1] = max(cluster[1], length)
+
+def read_uc(threads):
+    # Each cluster keeps only [common lineage node, longest member lineage length],
+    # narrowed as its members arrive. With threads > 1 byte ranges of the .uc file
+    # are read in parallel and merged in file order, so the output does not change.
+    size = os.path.getsize(options.uc)
+    if threads > 1:
+        num_shards = threads * SHARDS_PER_THREAD
+        bounds = [size * i // num_shards for i in range(num_shards + 1)]
+        with multiprocessing.Pool(threads) as pool:
+            shards = pool.imap(read_uc_shard_range, zip(bounds, bounds[1:]))
+            return merge_shards(shards)
+    return merge_shards([read_uc_shard(0, size)])
+
+def merge_shards(shards):
+    repseq = {}
+    line_offset = 0
+    for clusters, warnings, line_count, error_line in shards:
+
+        for query_id, seen in warnings:
+            if seen or query_id in repseq:
+                print(f"something wrong: {query_id}")
+
+        if error_line:
+            print(f"line {line_offset + error_line} in .uc file has < 10 fields", file = sys.stderr)
+            sys.exit(1)
+
+        for key, (node, length, has_s) in clusters.items():
+            if isinstance(tax, TaxIndex):
+                tax.load(node)  # Looked up by a worker
+            cluster = repseq.get(key)
+            if cluster is None or has_s:
+                repseq[key] = [node, length]
+            else:
+                narrow(cluster, node, length)
+
+        line_offset += line_count
 
     return repseq
 
-def read_tax():
-    tax = {}
+def read_tax_lines():
     with open(options.tax) as f:
         for line in f:
             parts = line.strip().split('\t')
             if parts:  # Skip empty lines
                 key = parts[0]
                 taxon = '\t'.join(parts[1:]) if len(parts) > 1 else None
-                taxon = taxonomy2list(taxon)
-                tax[key] = taxon
-    return tax
+                yield key, taxonomy2list(taxon)
+
+def read_tax():
+    return {key: lineages.intern(taxon) for key, taxon in read_tax_lines()}
+
+def tax_signature():
+    stat = os.stat(options.tax)
+    return f"{os.path.abspath(options.tax)}\t{stat.st_size}\t{stat.st_mtime_ns}"
+
+def index_is_current(index_file):
+    if not os.path.exists(index_file):
+        return False
+    with contextlib.closing(sqlite3.connect(f"file:{index_file}?mode=ro", uri = True)) as db:
+        try:
+            return db.execute("SELECT tax FROM meta").fetchone() == (tax_signature(),)
+        except sqlite3.DatabaseError:
+            return False
+
+def build_index(index_file):
+    # ID -> lineage node, and the lineage tree itself, which is small next to the IDs
+    temp_file = index_file + ".tmp"
+    if os.path.exists(temp_file):
+        os.remove(temp_file)
+    db = sqlite3.connect(temp_file)
+    db.execute("CREATE TABLE meta (tax TEXT)")
+    db.execute("CREATE TABLE ids (id TEXT PRIMARY KEY, node INTEGER) WITHOUT ROWID")
+    db.execute("CREATE TABLE nodes (node INTEGER PRIMARY KEY, parent INTEGER, name TEXT)")
+    db.executemany("INSERT OR REPLACE INTO ids VALUES (?, ?)",
+                   ((key, lineages.intern(taxon)) for key, taxon in read_tax_lines()))
+    db.executemany("INSERT INTO nodes VALUES (?, ?, ?)",
+                   ((node, lineages.parent[node], lineages.name[node]) for node in range(1, len(lineages.parent))))
+    db.execute("INSERT INTO meta VALUES (?)", (tax_signature(),))
+    db.commit()
+    db.close()
+    os.replace(temp_file, index_file)  # Never leave a partly written index behind
+
+class TaxIndex:
+    """Looks up taxonomy IDs in an index written by build_index(), loading only
+    the lineage tree nodes of the IDs it is asked for."""
+
+    def __init__(self, index_file):
+        self.index_file = index_file
+        self.pid = None
+        self.lineages = Lineages()
+        # Sparse copy of the tree: node -> parent, name and depth
+        self.lineages.parent = {0: 0}
+        self.lineages.name = {0: None}
+        self.lineages.depth = {0: 0}
+
+    def __getitem__(self, key):
+        row = self.connection().execute("SELECT node FROM ids WHERE id = ?", (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        self.load(row[0])
+        return row[0]
+
+    def connection(self):
+        # One connection per process: -t workers must not share the parent's
+        if self.pid != os.getpid():
+            self.db = sqlite3.connect(f"file:{self.index_file}?mode=ro", uri = True)
+            self.pid = os.getpid()
+        return self.db
+
+    def load(self, node):
+        path = []
+        while node not in self.lineages.parent:
+            parent, name = self.connection().execute("SELECT parent, name FROM nodes WHERE node = ?", (node,)).fetchone()
+            path.append((node, parent, name))
+            node = parent
+        for node, parent, name in reversed(path):
+            self.lineages.parent[node] = parent
+            self.lineages.name[node] = name
+            self.lineages.depth[node] = self.lineages.depth[parent] + 1
 
 def taxonomy2list(taxon):
     parts = taxon.split('|')
     result = [part.split('__', 1)[1] if '__' in part else part for part in parts]
     return result
 
-def lca(lists):
-    if not lists:
-        return []
-
-    min_length = min(len(lst) for lst in lists)
-    # print(min_length)
-    lca = []
-
-    for i in range(min_length):
-        elements = [lst[i] for lst in lists]
-        # print(elements)
-        if all(element == elements[0] for element in elements):
-            lca.append(elements[0])
-        else:
-            break
-
-    max_length = max(len(lst) for lst in lists)
+def lca(cluster):
+    # The common prefix, padded to the longest member lineage
+    node, max_length = cluster
+    lca = lineages.names(node)
     lca.extend([''] * (max_length - len(lca)))
-
     return lca
 
 def add_prefixes(lineage):
@@ -124,8 +302,16 @@ def add_prefixes(lineage):
 
 if __name__ == '__main__':
 
-    tax = read_tax()
-    repseq = read_uc()
+    lineages = Lineages()
+    if options.index:
+        if not index_is_current(options.index):
+            print(f"Indexing {options.tax}...")
+            build_index(options.index)
+        tax = TaxIndex(options.index)
+        lineages = tax.lineages
+    else:
+        tax = read_tax()
+    repseq = read_uc(int(options.threads))
 
     with open(options.outfile, "w") as outfile:
         for key, value in repseq.items():
@@ -1,6 +1,9 @@
 #!/usr/bin/python
 
 import sys
+import gzip
+import json
+import time
 
 ############################################################
 # Argument Options
@@ -9,16 +12,16 @@ import sys
 import argparse
 parser = argparse.ArgumentParser("Reads and writes each entry as a single file.")
 parser.add_argument("-i",
-                    action = "store", 
-                    dest = "infile", 
+                    action = "store",
+                    dest = "infile",
                     metavar = "infile",
-                    help = "[REQUIRED]", 
+                    help = "[REQUIRED] .uc file (plain or gzipped)",
                     required = True)
 parser.add_argument("-o",
                     action = "store",
                     dest = "outfile",
                     metavar = "outfile",
-                    help = "[REQUIRED]",
+                    help = "[REQUIRED] OTU table (gzipped if ending in .gz)",
                     required = True)
 parser.add_argument("-l",
                     action = "store",
@@ -26,87 +29,119 @@ parser.add_argument("-l",
                     metavar = "sampleids",
                     help = "[REQUIRED]",
                     required = True)
+parser.add_argument("-f",
+                    action = "store",
+                    dest = "format",
+                    metavar = "format",
+                    choices = ["tsv", "triplet", "biom"],
+                    help = "[OPTIONAL] tsv (dense table), triplet (OTU, sample, count of non-zero cells) or biom (BIOM 1.0 sparse JSON)",
+                    default = "tsv")
 options = parser.parse_args()
 
 ############################################################
 
-if __name__ == '__main__':
+def open_file(filename, mode = "rt"):
+    """Opens a file, through gzip if it is gzipped (reading) or named .gz (writing)."""
+    if "r" in mode:
+        with open(filename, "rb") as f:
+            gzipped = f.read(2) == b"\x1f\x8b"  # Gzip magic number
+    else:
+        gzipped = filename.endswith(".gz")
+    return gzip.open(filename, mode) if gzipped else open(filename, mode)
+
+def write_tsv(outfile, OTUNames, sampleids, counts):
+    """Writes the dense OTU table, one column per sample."""
+    outfile.write("#OTU_ID\t" + "\t".join(sampleids) + "\n")
+    for OTU, OTUCounts in zip(OTUNames, counts):
+        row = [0] * len(sampleids)
+        for sample, count in OTUCounts.items():
+            row[sample] = count
+        outfile.write(OTU + "\t" + "\t".join(map(str, row)) + "\n")
+
+def write_triplet(outfile, OTUNames, sampleids, counts):
+    """Writes one (OTU, sample, count) line per non-zero cell."""
+    outfile.write("#OTU_ID\tSampleID\tCount\n")
+    for OTU, OTUCounts in zip(OTUNames, counts):
+        for sample in sorted(OTUCounts):
+            outfile.write(OTU + "\t" + sampleids[sample] + "\t" + str(OTUCounts[sample]) + "\n")
+
+def write_biom(outfile, OTUNames, sampleids, counts):
+    """Writes a BIOM 1.0 sparse OTU table."""
+    table = {
+        "id": None,
+        "format": "Biological Observation Matrix 1.0.0",
+        "format_url": "http://biom-format.org",
+        "type": "OTU table",
+        "generated_by": "uc2otutable.py",
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "rows": [{"id": OTU, "metadata": None} for OTU in OTUNames],
+        "columns": [{"id": sampleid, "metadata": None} for sampleid in sampleids],
+        "matrix_type": "sparse",
+        "matrix_element_type": "int",
+        "shape": [len(OTUNames), len(sampleids)],
+        "data": [[OTUIndex, sample, OTUCounts[sample]] for OTUIndex, OTUCounts in enumerate(counts) for sample in sorted(OTUCounts)],
+    }
+    json.dump(table, outfile)
+    outfile.write("\n")
 
-    infile = open(options.infile, "r")
-    sampleids = open(options.sampleids, "r")
-    outfile = open(options.outfile, "w")
+if __name__ == '__main__':
 
-    line_count = 0
+    # Load sample IDs first, so every hit is counted straight into its column
+    sampleids = []
+    for line in open(options.sampleids):
+        if line[0] != "#":
+            sampleids.append(line.split("\t")[0].rstrip())
+    sampleIndex = {sampleid: i for i, sampleid in enumerate(sampleids)}
 
-    OTUs = {}
+    # Sparse table: OTU index -> {sample index: count}, OTUs in order of first appearance
+    OTUIndex = {}
+    OTUNames = []
+    counts = []
 
-    OTUCount = 0
-    
-    while True:
+    infile = open_file(options.infile)
+    line_count = 0
 
-        line = infile.readline().rstrip()
+    for line in infile:
 
-        if len(line) == 0:
-            break
-        
         line_count += 1
-        fields = line.split("\t")               
 
         # Some filters
-        if line[0] == '#' or (fields[0] != 'H' and fields[0] != 'S'):
+        if line[0] != 'H' and line[0] != 'S':
             continue
-            
+
+        fields = line.rstrip().split("\t")
         if len(fields) < 10:
-            print >> sys.stderr, "line %d in .uc file has < 10 fields" % line_count
+            print("line %d in .uc file has < 10 fields" % line_count, file = sys.stderr)
             exit(1)
 
-            
         if fields[0] == "S":
-            if fields[8] in OTUs.keys():
-                print("something wrong: " + fields[8])
-                
-            OTUs[fields[8]] = [fields[8].split("_")[0]]
-            OTUCount += 1
+            OTU = fields[8]
+            if OTU in OTUIndex:
+                print("something wrong: " + OTU)
+                # A repeated S record starts the OTU's counts again, as the member lists did
+                counts[OTUIndex[OTU]].clear()
         elif fields[0] == "H":
+            OTU = fields[9]
+        else:
+            continue
 
-      #      print(fields[8].split("_")[0])
-            try:
-                OTUs[fields[9]].append(fields[8].split("_")[0])
-            except:
-                OTUs[fields[9]] = [fields[8].split("_")[0]]
-
-    print(len(OTUs))
-                
-    #for k, v in OTUs.items():
-    #    print(k, v)
-                
-    # Load sample IDs
-    sampleids = []
-    for line in open(options.sampleids):
-        if line[0] != "#":
-            sampleids.append(line.split("\t")[0].rstrip())
-
-    
-    # header with sampleids
-    outfile.write("#OTU_ID\t" + "\t".join(sampleids) + "\n")
-
-    # OTU table
-    for OTU, members in OTUs.items():
-
-        # For each OTU
-        outfile.write(OTU)
-
-        # For each sample:
-        subtotalnumber = 0
-        for sampleid in sampleids:
-            outfile.write("\t" + str(members.count(sampleid)))
-            subtotalnumber += members.count(sampleid)
-
-        if len(members) != subtotalnumber:
-            print("Something wrong!")
+        sampleid = fields[8].split("_", 1)[0]
+        sample = sampleIndex.get(sampleid)
+        if sample is None:
+            print("Something wrong! Sample " + sampleid + " of " + fields[8] + " is not in " + options.sampleids)
             exit(1)
-        
-        outfile.write("\n")
+
+        index = OTUIndex.get(OTU)
+        if index is None:
+            index = OTUIndex[OTU] = len(OTUNames)
+            OTUNames.append(OTU)
+            counts.append({})
+        OTUCounts = counts[index]
+        OTUCounts[sample] = OTUCounts.get(sample, 0) + 1
 
     infile.close()
+    print(len(OTUNames))
+
+    outfile = open_file(options.outfile, "wt")
+    {"tsv": write_tsv, "triplet": write_triplet, "biom": write_biom}[options.format](outfile, OTUNames, sampleids, counts)
     outfile.close()